@@ -1,25 +1,465 @@
 import os
+import io
+import csv
+import codecs
+import itertools
+import threading
+import heapq
+import bisect
+import multiprocessing
+import time
+import queue
+import zlib
+import json
+import base64
+import tempfile
+import click
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import psycopg2
 import pandas as pd
 import numpy as np
 import re
-from psycopg2.extras import RealDictCursor, execute_batch
-from flask import Flask, render_template, request, redirect, url_for, flash, Response
+from psycopg2.extras import RealDictCursor, execute_batch, execute_values
+from openpyxl import Workbook, load_workbook
+from flask import Flask, render_template, request, redirect, url_for, flash, Response, jsonify, abort, send_file, g
+from werkzeug.datastructures import FileStorage
 
 app = Flask(__name__)
 app.secret_key = 'super_secret_key_change_me'
 
 DB_URL = os.getenv("DATABASE_URL", "postgresql://postgres:password@db:5432/mishloach_db")
 
+# --- מדדים (פורמט טקסט של Prometheus, /metrics) ---
+# המדדים נשמרים בזיכרון של התהליך: עם כמה תהליכים (gunicorn) כל אחד מדווח על עצמו
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "0"))  # 0 = בלי לוג בקשות איטיות
+SLOW_REQUEST_TOP_QUERIES = int(os.getenv("SLOW_REQUEST_TOP_QUERIES", "5"))
+METRICS = []
+
+def metric_labels(names, values):
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{n}="{esc(v)}"' for n, v in zip(names, values))
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name, self.help, self.labels = name, help, labels
+        self._lock = threading.Lock()
+        self._values = {}
+        METRICS.append(self)
+
+    def inc(self, labels, amount=1):
+        with self._lock: self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock: values = sorted(self._values.items())
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} counter\n"
+        for labels, v in values: yield f"{self.name}{{{metric_labels(self.labels, labels)}}} {v}\n"
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # labels -> [מונה לכל bucket (לא מצטבר) + inf, סכום]
+        METRICS.append(self)
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(labels)
+            if v is None: v = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            v[0][i] += 1
+            v[1] += value
+
+    def render(self):
+        with self._lock: values = sorted((k, (list(c), s)) for k, (c, s) in self._values.items())
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} histogram\n"
+        for labels, (counts, total) in values:
+            base = metric_labels(self.labels, labels)
+            running = 0
+            for le, c in zip(self.buckets + ('+Inf',), counts):
+                running += c
+                yield f'{self.name}_bucket{{{base},le="{le}"}} {running}\n'
+            yield f"{self.name}_sum{{{base}}} {total}\n{self.name}_count{{{base}}} {running}\n"
+
+HTTP_REQUESTS = Counter('mishloach_http_requests_total', 'HTTP requests by endpoint and status.', ('endpoint', 'method', 'status'))
+HTTP_DURATION = Histogram('mishloach_http_request_duration_seconds', 'Request latency by Flask endpoint.', ('endpoint', 'method'),
+                          (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+REQUEST_QUERIES = Histogram('mishloach_http_request_queries', 'SQL statements per request.', ('endpoint',),
+                            (1, 2, 5, 10, 20, 50, 100, 500, 1000))
+SQL_DURATION = Histogram('mishloach_sql_query_duration_seconds', 'SQL statement time by context (endpoint / job) and verb.',
+                         ('context', 'verb'), (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+PHASE_DURATION = Histogram('mishloach_phase_duration_seconds', 'Time per phase of distribution and resident import runs.',
+                           ('operation', 'phase'), (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600))
+
+SQL_VERBS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'COPY', 'CREATE', 'DROP', 'TRUNCATE', 'ALTER', 'SET',
+             'ANALYZE', 'EXPLAIN', 'LOCK', 'BEGIN', 'COMMIT', 'ROLLBACK', 'DO', 'CALL'}
+metrics_local = threading.local()  # QueryStats של הבקשה / העבודה שרצה ב-thread הנוכחי
+
+class QueryStats:
+    """מספר וזמן הפקודות בהקשר אחד (בקשה או עבודת רקע), ו-N הפקודות האיטיות ביותר."""
+    def __init__(self, context):
+        self.context, self.count, self.seconds, self.slowest = context, 0, 0.0, []
+
+    def add(self, text, elapsed):
+        self.count += 1
+        self.seconds += elapsed
+        # heap קטן: רק הפקודות האיטיות נשמרות, גם בעבודה עם מיליון פקודות
+        item = (elapsed, self.count, text)
+        if len(self.slowest) < SLOW_REQUEST_TOP_QUERIES: heapq.heappush(self.slowest, item)
+        elif elapsed > self.slowest[0][0]: heapq.heapreplace(self.slowest, item)
+
+@contextmanager
+def query_context(name):
+    prev = getattr(metrics_local, 'stats', None)
+    stats = metrics_local.stats = QueryStats(name)
+    try: yield stats
+    finally: metrics_local.stats = prev
+
+def record_query(query, elapsed):
+    head = query[:300] if isinstance(query, (str, bytes)) else str(query)[:300]
+    if isinstance(head, bytes): head = head.decode('utf-8', 'ignore')
+    words = head.split(None, 1)
+    verb = words[0].upper() if words and words[0].upper() in SQL_VERBS else 'OTHER'
+    stats = getattr(metrics_local, 'stats', None)
+    SQL_DURATION.observe((stats.context if stats else 'other', verb), elapsed)
+    if stats: stats.add(' '.join(head.split())[:200], elapsed)
+
+class TimedCursorMixin:
+    # כל פקודה שעוברת ב-cursor נמדדת (execute_values / execute_batch קוראים ל-execute לכל עמוד)
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try: return super().execute(query, vars)
+        finally: record_query(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try: return super().executemany(query, vars_list)
+        finally: record_query(query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try: return super().copy_expert(sql, file, size)
+        finally: record_query(sql, time.perf_counter() - start)
+
+timed_cursor_classes = {}
+
+class TimedConnection(psycopg2.extensions.connection):
+    """חיבור שכל cursor שלו (כולל RealDictCursor ו-cursor עם שם) מודד את הפקודות."""
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        timed = timed_cursor_classes.get(factory)
+        if timed is None: timed = timed_cursor_classes[factory] = type('Timed' + factory.__name__, (TimedCursorMixin, factory), {})
+        kwargs['cursor_factory'] = timed
+        return super().cursor(*args, **kwargs)
+
+class PhaseTimer:
+    """זמן כולל לכל שלב של ריצה אחת (שלב יכול לחזור, למשל בכל chunk). record() רושם ל-PHASE_DURATION."""
+    def __init__(self, operation=None):
+        self.operation, self.seconds = operation, {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try: yield
+        finally: self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def iterate(self, name, iterable):
+        # הזמן של next() נספר לשלב (למשל קריאת chunk מהקובץ)
+        it = iter(iterable)
+        while True:
+            with self.phase(name):
+                try: item = next(it)
+                except StopIteration: return
+            yield item
+
+    def record(self):
+        if self.operation is None: return
+        for name, seconds in self.seconds.items(): PHASE_DURATION.observe((self.operation, name), seconds)
+
 def get_db_connection():
+    # חיבור ישיר (לסקריפטים ולמדידות). בקשות HTTP משתמשות ב-db_connection() מה-pool
     try:
-        conn = psycopg2.connect(DB_URL)
+        conn = psycopg2.connect(DB_URL, connection_factory=TimedConnection)
         conn.autocommit = True
         return conn
     except Exception as e:
         print(f"DB Connection Error: {e}")
         return None
 
+# --- Pool חיבורים ---
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE", "30"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+
+class PoolTimeout(Exception):
+    pass
+
+class DatabaseUnavailable(psycopg2.OperationalError):
+    # כשל בפתיחת חיבור (השרת למטה, סיסמה, רשת). שגיאות של פקודה (ביטול, deadlock, lock timeout) נשארות OperationalError
+    pass
+
+class ConnectionPool:
+    """Pool חיבורים לכל התהליך: עד maxconn פתוחים, לפחות minconn נשמרים גם כשלא בשימוש,
+    המתנה מוגבלת בזמן, בדיקת חיבור שעמד זמן רב ומדדים."""
+
+    def __init__(self, dsn, minconn, maxconn, timeout, check_idle, max_idle):
+        self.dsn, self.minconn, self.maxconn = dsn, minconn, maxconn
+        self.timeout, self.check_idle, self.max_idle = timeout, check_idle, max_idle
+        self._cond = threading.Condition()
+        self._idle = []  # (conn, זמן החזרה)
+        self._in_use = 0
+        self._pid = None
+        self._started = time.monotonic()
+        self._stats = {'checkouts': 0, 'timeouts': 0, 'reconnects': 0, 'discarded': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+
+    def _connect(self):
+        try: conn = psycopg2.connect(self.dsn, connection_factory=TimedConnection)
+        except psycopg2.OperationalError as e: raise DatabaseUnavailable(str(e).strip()) from e
+        conn.autocommit = True
+        return conn
+
+    def _after_fork(self):
+        # חיבורים שנפתחו בתהליך האב אסור לשתף (reloader של Flask, workers)
+        if self._pid != os.getpid():
+            self._idle, self._in_use, self._pid = [], 0, os.getpid()
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed: return False
+        if time.monotonic() - idle_since < self.check_idle: return True
+        try:
+            with conn.cursor() as cur: cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start = time.monotonic()
+        with self._cond:
+            self._after_fork()
+            while not self._idle and self._in_use + len(self._idle) >= self.maxconn:
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f"אין חיבור פנוי ל-DB אחרי {self.timeout} שניות ({self.maxconn} בשימוש)")
+                self._cond.wait(remaining)
+            conn, idle_since = self._idle.pop() if self._idle else (None, None)
+            self._in_use += 1
+            waited = time.monotonic() - start
+            self._stats['checkouts'] += 1
+            self._stats['wait_total'] += waited
+            self._stats['wait_max'] = max(self._stats['wait_max'], waited)
+        try:
+            if conn is not None and not self._healthy(conn, idle_since):
+                self._close(conn)
+                conn = None
+                with self._cond: self._stats['reconnects'] += 1
+            return conn if conn is not None else self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn):
+        # מחזיר את החיבור למצב ההתחלתי (autocommit, בלי טרנזקציה פתוחה); חיבור שבור נזרק
+        try:
+            if not conn.closed:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                conn.autocommit = True
+        except psycopg2.Error:
+            self._close(conn)
+        stale = []
+        with self._cond:
+            if self._pid == os.getpid():
+                self._in_use -= 1
+                if conn.closed: self._stats['discarded'] += 1
+                else: self._idle.append((conn, time.monotonic()))
+                # מעבר ל-minconn: סוגרים חיבורים שלא נגעו בהם max_idle שניות (הישנים בתחילת הרשימה)
+                now = time.monotonic()
+                while len(self._idle) > self.minconn and now - self._idle[0][1] > self.max_idle:
+                    stale.append(self._idle.pop(0)[0])
+            self._cond.notify()
+        for old in stale: self._close(old)
+
+    def _close(self, conn):
+        try: conn.close()
+        except psycopg2.Error: pass
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s.update(size=self._in_use + len(self._idle), in_use=self._in_use, idle=len(self._idle),
+                     min=self.minconn, max=self.maxconn)
+        uptime = time.monotonic() - self._started
+        s['wait_avg'] = s['wait_total'] / s['checkouts'] if s['checkouts'] else 0.0
+        s['checkouts_per_sec'] = s['checkouts'] / uptime if uptime else 0.0
+        return s
+
+db_pool = ConnectionPool(DB_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_CHECK_IDLE, DB_POOL_MAX_IDLE)
+
+@contextmanager
+def db_connection():
+    conn = db_pool.getconn()
+    try: yield conn
+    finally: db_pool.putconn(conn)
+
+@contextmanager
+def db_cursor(cursor_factory=RealDictCursor):
+    with db_connection() as conn:
+        cur = conn.cursor(cursor_factory=cursor_factory)
+        try: yield cur
+        finally: cur.close()
+
+# --- עבודות רקע ---
+# קליטת תושבים, טעינת הזמנות והפצה רצות ב-thread pool של התהליך, והבקשה שמתחילה אותן חוזרת מיד.
+# המצב וההתקדמות נשמרים בטבלה jobs (מיגרציה 0007), כך ש-/jobs/<id> עונה מכל תהליך.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_PROGRESS_INTERVAL = float(os.getenv("JOB_PROGRESS_INTERVAL", "1"))
+JOB_UPLOAD_DIR = os.getenv("JOB_UPLOAD_DIR", tempfile.gettempdir())
+JOB_COLUMNS = ("id, kind, status, phase, rows_done, rows_total, messages, error, cancel_requested, "
+               "created_at, started_at, updated_at, finished_at")
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """הצד של העבודה עצמה: דיווח שלב ושורות, ובדיקת ביטול. NO_JOB = קריאה רגילה, בלי דיווח."""
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self._phase, self._done, self._total = None, 0, None
+        self._last = 0.0
+
+    def update(self, phase=None, done=None, total=None):
+        # נכתב כשהשלב מתחלף או פעם ב-JOB_PROGRESS_INTERVAL; באותה פקודה נקרא סימון הביטול
+        if self.id is None: return
+        changed = phase is not None and phase != self._phase
+        if phase is not None: self._phase = phase
+        if done is not None: self._done = done
+        if total is not None: self._total = total
+        now = time.monotonic()
+        if not changed and now - self._last < JOB_PROGRESS_INTERVAL: return
+        self._last = now
+        with db_cursor(None) as cur:
+            cur.execute("UPDATE jobs SET phase=%s, rows_done=%s, rows_total=%s, updated_at=now() WHERE id=%s RETURNING cancel_requested",
+                        (self._phase, self._done, self._total, self.id))
+            if cur.fetchone()[0]: raise JobCancelled(f"עבודה {self.id} בוטלה")
+
+    @contextmanager
+    def attached(self, conn):
+        # החיבור שמריץ את העבודה: ביטול שולח לו pg_cancel_backend, כך שגם פקודת SQL ארוכה נעצרת
+        if self.id is None:
+            yield
+            return
+        self._set_backend(conn.get_backend_pid())
+        try: yield
+        finally: self._set_backend(None)
+
+    def _set_backend(self, pid):
+        with db_cursor(None) as cur:
+            cur.execute("UPDATE jobs SET backend_pid=%s WHERE id=%s", (pid, self.id))
+
+    def finish(self, status, messages, error):
+        with db_cursor(None) as cur:
+            # עבודה שנכשלה אחרי בקשת ביטול (למשל QueryCanceled) = בוטלה; עבודה שהסתיימה נשארת done
+            cur.execute("""
+                UPDATE jobs SET status = CASE WHEN cancel_requested AND %(status)s <> 'done' THEN 'cancelled' ELSE %(status)s END,
+                    phase=%(phase)s, rows_done=%(done)s, rows_total=%(total)s, messages=%(messages)s,
+                    error = CASE WHEN cancel_requested AND %(status)s <> 'done' THEN NULL ELSE %(error)s END,
+                    backend_pid=NULL, updated_at=now(), finished_at=now()
+                WHERE id=%(id)s
+            """, {'status': status, 'phase': self._phase, 'done': self._done, 'total': self._total,
+                  'messages': messages, 'error': error, 'id': self.id})
+
+NO_JOB = Job(None)
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+
+def remove_upload(path):
+    if not path: return
+    try: os.remove(path)
+    except FileNotFoundError: pass
+
+def run_job(job, kind, fn, args, upload=None):
+    try:
+        with db_cursor(None) as cur:
+            cur.execute("UPDATE jobs SET status='running', started_at=now(), updated_at=now() WHERE id=%s AND status='queued'", (job.id,))
+            if cur.rowcount == 0: return  # בוטלה לפני שהתחילה
+        try:
+            with query_context(f'job:{kind}'): messages = list(fn(job, *args) or [])
+            job.finish('done', messages, None)
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job.finish('failed', [], str(e))
+        finally:
+            # גם עבודה שנכשלה או בוטלה יכלה לכתוב חלק מהשורות (הפצה בפייתון, shard-ים שהסתיימו)
+            invalidate_dashboard_stats()
+    finally:
+        remove_upload(upload)
+
+def submit_job(kind, fn, *args, upload=None):
+    """רושם עבודה ומריץ ברקע את fn(job, *args), שמחזירה רשימת הודעות. מחזיר את מזהה העבודה.
+    upload = קובץ מ-save_upload: העבודה מוחקת אותו כשהיא מסתיימת, נכשלת או מבוטלת (גם לפני שהתחילה)."""
+    with db_cursor(None) as cur:
+        cur.execute("INSERT INTO jobs (kind, upload_path) VALUES (%s, %s) RETURNING id", (kind, upload))
+        job_id = cur.fetchone()[0]
+    job_executor.submit(run_job, Job(job_id), kind, fn, args, upload)
+    return job_id
+
+def job_redirect(endpoint, job_id):
+    # המזהה גם בכותרת X-Job-Id, לסקריפטים (bench_suite) שלא קוראים את הודעת ה-flash
+    resp = redirect(url_for(endpoint))
+    if job_id: resp.headers['X-Job-Id'] = str(job_id)
+    return resp
+
+def get_job(job_id):
+    with db_cursor() as cur:
+        cur.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE id = %s", (job_id,))
+        return cur.fetchone()
+
+def recent_jobs(kinds, limit=5):
+    with db_cursor() as cur:
+        cur.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE kind = ANY(%s) ORDER BY id DESC LIMIT %s", (list(kinds), limit))
+        return cur.fetchall()
+
+def active_job(kind):
+    with db_cursor() as cur:
+        cur.execute("SELECT id FROM jobs WHERE kind = %s AND status IN ('queued', 'running') ORDER BY id LIMIT 1", (kind,))
+        row = cur.fetchone()
+    return row['id'] if row else None
+
+def cancel_job(job_id):
+    """עבודה בתור מבוטלת מיד; עבודה רצה מסומנת, והפקודה הנוכחית שלה נקטעת."""
+    # pg_cancel_backend באותה פקודה שנועלת את שורת העבודה: העבודה מנקה את backend_pid (attached) לפני שהחיבור
+    # חוזר ל-pool, וזה מחכה לנעילה - כך שהאות לא יכול להגיע לבקשה אחרת שקיבלה את אותו חיבור
+    with db_cursor(None) as cur:
+        cur.execute("""
+            WITH c AS (
+                UPDATE jobs SET cancel_requested = true,
+                    status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,
+                    finished_at = CASE WHEN status = 'queued' THEN now() ELSE finished_at END
+                WHERE id = %s AND status IN ('queued', 'running')
+                RETURNING status, backend_pid)
+            SELECT CASE WHEN status = 'running' AND backend_pid IS NOT NULL THEN pg_cancel_backend(backend_pid) END FROM c
+        """, (job_id,))
+        return cur.fetchone() is not None
+
+def fail_interrupted_jobs():
+    # ה-thread pool לא שורד הפעלה מחדש: עבודות שלא הסתיימו לא ימשיכו
+    with db_cursor(None) as cur:
+        cur.execute("""UPDATE jobs SET status='failed', error='השרת הופעל מחדש באמצע העבודה', backend_pid=NULL, finished_at=now()
+                       WHERE status IN ('queued', 'running') RETURNING upload_path""")
+        for (path,) in cur.fetchall(): remove_upload(path)
+
+def save_upload(file):
+    # הקובץ נשמר לדיסק לפני שהבקשה חוזרת; העבודה קוראת ממנו, ו-run_job מוחק אותו (submit_job(..., upload=path))
+    fd, path = tempfile.mkstemp(prefix='upload_', suffix=os.path.splitext(file.filename or '')[1], dir=JOB_UPLOAD_DIR)
+    with os.fdopen(fd, 'wb') as out: file.save(out)
+    return path
+
 # --- פונקציות עזר ---
 def handle_series(val):
     if isinstance(val, pd.Series): return val.iloc[0]
@@ -33,13 +473,17 @@ def clean_int_str(val):
         return str(int(float(clean_val)))
     except: return str(val).strip()
 
-def normalize_phone(p):
-    if not p: return None
-    clean = re.sub(r'\D', '', str(p))
-    if not clean: return None
-    if clean.startswith('972'): clean = '0' + clean[3:]
-    clean = clean.lstrip('0')
-    return '0' + clean
+def normalize_phone(p, default_area='02'):
+    # זהה ל-format_il_phone ב-SQL (כולל קידומת ברירת מחדל), כדי ששני מנועי ההפצה יתאימו אותו דבר
+    if p is None or str(p).strip() == '': return None
+    e = re.sub(r'\D', '', str(p))
+    if e.startswith('972'): e = '0' + e[3:]
+    # אפס מוביל שנפל (Excel): נייד 5XXXXXXXX או קווי [23489]XXXXXXX (מיגרציה 0012)
+    if re.fullmatch(r'5\d{8}|[23489]\d{7}', e): e = '0' + e
+    if not e.startswith('0'): e = default_area + e
+    e = re.sub(r'^0+', '0', e)
+    if len(e) == 7: e = default_area + e
+    return e if 7 <= len(e) <= 10 else None
 
 def safe_int(val):
     val = handle_series(val)
@@ -49,28 +493,33 @@ def safe_int(val):
     except: return 0
 
 # --- קליטת נתונים חכמה ---
+RESIDENT_FIELD_OPTIONS = {
+    'code': ['code', 'order_code', 'קוד', 'קוד מזמין', 'id'],
+    'lastname': ['lastname', 'last_name', 'משפחה', 'שם משפחה'],
+    'father_name': ['father_name', 'father_first_name', 'שם אבא', 'שם פרטי', 'פרטי'],
+    'mother_name': ['mother_name', 'mother_first_name', 'שם אמא', 'שם האשה', 'אשה'],
+    'streetname': ['streetname', 'street', 'רחוב', 'כתובת'],
+    'buildingnumber': ['buildingnumber', 'building_number', 'בנין', 'מס בית', 'מספר בית'],
+    'entrance': ['entrance', 'כניסה'],
+    'apartmentnumber': ['apartmentnumber', 'apartment_number', 'דירה', 'מספר דירה'],
+    'phone': ['phone', 'home_phone', 'טלפון', 'טלפון בבית'],
+    'mobile': ['mobile', 'נייד', 'נייד 1', 'סלולרי'],
+    'mobile2': ['mobile2', 'נייד 2', 'נייד אשה', 'סלולרי 2'],
+    'email': ['email', 'מייל', 'אימייל', 'דואר אלקטרוני'],
+    'standing_order': ['standing_order', 'הוראת קבע']
+}
+
+def clean_column_name(c):
+    return str(c).strip().lower().replace('\ufeff', '').replace('"', '').replace("'", "")
+
 def extract_clean_data(df):
     clean_rows = []
     
     # ניקוי שמות עמודות (BOM, רווחים)
-    df.columns = [str(c).strip().lower().replace('\ufeff', '').replace('"', '').replace("'", "") for c in df.columns]
+    df.columns = [clean_column_name(c) for c in df.columns]
     df = df.loc[:, ~df.columns.duplicated()]
     
-    field_options = {
-        'code': ['code', 'order_code', 'קוד', 'קוד מזמין', 'id'],
-        'lastname': ['lastname', 'last_name', 'משפחה', 'שם משפחה'],
-        'father_name': ['father_name', 'father_first_name', 'שם אבא', 'שם פרטי', 'פרטי'],
-        'mother_name': ['mother_name', 'mother_first_name', 'שם אמא', 'שם האשה', 'אשה'],
-        'streetname': ['streetname', 'street', 'רחוב', 'כתובת'],
-        'buildingnumber': ['buildingnumber', 'building_number', 'בנין', 'מס בית', 'מספר בית'],
-        'entrance': ['entrance', 'כניסה'],
-        'apartmentnumber': ['apartmentnumber', 'apartment_number', 'דירה', 'מספר דירה'],
-        'phone': ['phone', 'home_phone', 'טלפון', 'טלפון בבית'],
-        'mobile': ['mobile', 'נייד', 'נייד 1', 'סלולרי'],
-        'mobile2': ['mobile2', 'נייד 2', 'נייד אשה', 'סלולרי 2'],
-        'email': ['email', 'מייל', 'אימייל', 'דואר אלקטרוני'],
-        'standing_order': ['standing_order', 'הוראת קבע']
-    }
+    field_options = RESIDENT_FIELD_OPTIONS
 
     # זיהוי עמודת קוד
     code_col_name = None
@@ -115,338 +564,1339 @@ def extract_clean_data(df):
         clean_rows.append(new_row)
     return clean_rows, detected_col_msg
 
-# --- מנוע הפצה (פייתון) ---
-def distribute_in_python():
-    conn = get_db_connection()
-    if not conn: return 0, ["שגיאת חיבור"]
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    messages = []
-    total_orders = 0
-    
+RAW_RESIDENT_COLUMNS = ['code', 'lastname', 'father_name', 'mother_name', 'streetname', 'buildingnumber', 'entrance',
+                        'apartmentnumber', 'phone', 'mobile', 'mobile2', 'email', 'standing_order']
+CSV_ENCODINGS = ['utf-8-sig', 'cp1255', 'utf-8', 'windows-1252', 'iso-8859-8']
+IMPORT_CHUNK_ROWS = int(os.getenv("IMPORT_CHUNK_ROWS", "20000"))
+RESIDENT_IMPORT_MODE = os.getenv("RESIDENT_IMPORT_MODE", "stream")
+
+def find_header_row(df):
+    # זיהוי שורת כותרת ב-30 השורות הראשונות
+    for i, row in df.head(30).iterrows():
+        txt = " ".join([str(v) for v in row.values]).lower()
+        if 'lastname' in txt or 'משפחה' in txt or 'code' in txt or 'קוד' in txt:
+            return i
+    return -1
+
+def read_uploaded_table(file):
+    # הנתיב הישן: כל הקובץ ל-DataFrame אחד
+    df = None
+    fname = file.filename.lower()
+    if fname.endswith('.xlsx'):
+        try: df = pd.read_excel(file, engine='openpyxl', header=None)
+        except: pass
+    if df is None:
+        for enc in CSV_ENCODINGS:
+            try:
+                file.seek(0)
+                df = pd.read_csv(file, encoding=enc, header=None, sep=None, engine='python')
+                if df.shape[1] > 1: break
+            except: continue
+    return df
+
+def load_residents_legacy(file, cur, job=NO_JOB, phases=None):
+    phases = phases or PhaseTimer()
+    with phases.phase('parse'):
+        df = read_uploaded_table(file)
+        if df is None: return None
+        header_idx = find_header_row(df)
+        if header_idx > -1:
+            df.columns = df.iloc[header_idx]
+            df = df[header_idx + 1:].reset_index(drop=True)
+        else:
+            df.columns = df.iloc[0]
+            df = df[1:].reset_index(drop=True)
+
+    with phases.phase('normalize'):
+        clean, diag_msg = extract_clean_data(df)
+        vals = []
+        sample_codes = []
+        for r in clean:
+            if r['code']:
+                if len(sample_codes) < 5: sample_codes.append(str(r['code']))
+            vals.append(tuple(r[c] for c in RAW_RESIDENT_COLUMNS))
+
+    with phases.phase('load'):
+        cur.execute("TRUNCATE TABLE raw_residents_csv RESTART IDENTITY")
+        q = f"INSERT INTO raw_residents_csv ({', '.join(RAW_RESIDENT_COLUMNS)}) VALUES ({', '.join(['%s'] * len(RAW_RESIDENT_COLUMNS))})"
+        execute_batch(cur, q, vals)
+    job.update(done=len(vals))
+    return len(vals), diag_msg, sample_codes
+
+# --- קליטה בזרימה (chunks + COPY) ---
+def iter_xlsx_chunks(wb, chunk_rows):
     try:
-        # טעינת מפת תושבים (קוד וטלפון)
-        cur.execute("SELECT personid, phone, mobile, mobile2 FROM person")
-        people = cur.fetchall()
-        id_map = {str(p['personid']): p['personid'] for p in people}
-        phone_map = {}
-        for p in people:
-            pid = p['personid']
-            for field in ['phone', 'mobile', 'mobile2']:
-                norm = normalize_phone(p[field])
-                if norm: phone_map[norm] = pid
-
-        cur.execute("SELECT * FROM outerapporder WHERE status IN ('waiting', 'error')")
-        orders = cur.fetchall()
+        rows = []
+        for values in wb.active.iter_rows(values_only=True):
+            # כמו read_excel: מספר שלם שנשמר כ-float חוזר כ-int
+            rows.append(tuple(int(v) if isinstance(v, float) and v.is_integer() else v for v in values))
+            if len(rows) >= chunk_rows:
+                yield pd.DataFrame(rows, dtype=object)
+                rows = []
+        if rows: yield pd.DataFrame(rows, dtype=object)
+    finally:
+        wb.close()
+
+def sniff_csv(file):
+    # קידוד, מפריד ורוחב לפי 64KB ראשונים, באותו סדר ניסיונות כמו הנתיב הישן
+    head = file.read(65536)
+    file.seek(0)
+    fallback = None
+    for enc in CSV_ENCODINGS:
+        try: sample = codecs.getincrementaldecoder(enc)().decode(head)
+        except UnicodeDecodeError: continue
+        try: sep = csv.Sniffer().sniff(sample, delimiters=',;\t|').delimiter
+        except csv.Error: sep = ','
+        width = max(len(r) for r in csv.reader(io.StringIO(sample.lstrip('\ufeff')), delimiter=sep)) if sample else 0
+        if width > 1: return enc, sep, width
+        if fallback is None: fallback = (enc, sep, max(width, 1))
+    return fallback
+
+def read_table_chunks(file, chunk_rows=IMPORT_CHUNK_ROWS):
+    """מחזיר מחולל של DataFrame-ים (ללא כותרת, כל הערכים כטקסט) בלי לטעון את כל הקובץ לזיכרון."""
+    stream = file.stream
+    if file.filename.lower().endswith('.xlsx'):
+        try: return iter_xlsx_chunks(load_workbook(stream, read_only=True, data_only=True), chunk_rows)
+        except Exception: stream.seek(0)
+    sniffed = sniff_csv(stream)
+    if sniffed is None: return None
+    enc, sep, width = sniffed
+    # names קבוע: שורות פתיחה קצרות (כותרת דוח וכו') לא שוברות את הקריאה
+    return pd.read_csv(stream, encoding=enc, sep=sep, header=None, names=range(width), dtype=str,
+                       keep_default_na=False, chunksize=chunk_rows)
+
+def resolve_resident_columns(header, first_rows):
+    # מיפוי שדה -> אינדקסי עמודות מועמדות (לפי סדר העדיפות ב-RESIDENT_FIELD_OPTIONS)
+    positions = {}
+    for idx, name in enumerate(header):
+        positions.setdefault(clean_column_name(name), idx)
+
+    code_col, code_name = None, None
+    for opt in RESIDENT_FIELD_OPTIONS['code']:
+        if opt in positions:
+            code_col, code_name = positions[opt], opt
+            break
+    if code_col is None and len(header) > 0:
+        sample = [str(x) for x in first_rows[0].tolist() if pd.notnull(x) and str(x) != ''][:5]
+        if sample and all(x.replace('.', '').isdigit() for x in sample):
+            code_col, code_name = 0, clean_column_name(header[0])
+
+    plan = {field: [positions[opt] for opt in options if opt in positions]
+            for field, options in RESIDENT_FIELD_OPTIONS.items() if field != 'code'}
+    diag_msg = f"עמודת קוד: {code_name}" if code_col is not None else "לא זוהתה עמודת קוד (יקבלו מספר 100,000+)"
+    return plan, code_col, diag_msg
+
+def as_text(s):
+    return s.where(s.notna(), '').astype(str)
+
+def to_int_column(s):
+    # מקבילה וקטורית ל-safe_int
+    nums = pd.to_numeric(as_text(s).str.strip(), errors='coerce').replace([np.inf, -np.inf], np.nan)
+    return nums.fillna(0).astype('int64')
+
+def normalize_resident_chunk(df, plan, code_col):
+    """גרסה וקטורית של extract_clean_data עבור chunk אחד."""
+    out = pd.DataFrame(index=df.index)
+    out['code'] = to_int_column(df[code_col]) if code_col is not None else None
+    for field, cols in plan.items():
+        vals = pd.Series('', index=df.index)
+        for col in reversed(cols):
+            s = as_text(df[col])
+            vals = s.where(s.str.strip() != '', vals)
+        out[field] = vals
+    out['standing_order'] = to_int_column(out['standing_order'])
+    # דילוג על שורות ריקות
+    has_code = out['code'].fillna(0).astype(bool) if code_col is not None else False
+    return out[(out['lastname'] != '') | has_code][RAW_RESIDENT_COLUMNS]
+
+def copy_residents_chunk(cur, chunk):
+    buf = io.StringIO()
+    chunk.to_csv(buf, header=False, index=False, quoting=csv.QUOTE_ALL)
+    buf.seek(0)
+    cur.copy_expert(f"COPY raw_residents_csv ({', '.join(RAW_RESIDENT_COLUMNS)}) "
+                    "FROM STDIN WITH (FORMAT csv, FORCE_NULL (code))", buf)
+
+def load_residents_stream(file, cur, job=NO_JOB, phases=None):
+    phases = phases or PhaseTimer()
+    with phases.phase('parse'):
+        chunks = read_table_chunks(file)
+        first = next(chunks, None) if chunks is not None else None
+        if first is None: return None
+
+        header_idx = find_header_row(first)
+        if header_idx == -1: header_idx = first.index[0]
+        header = first.loc[header_idx].tolist()
+        first = first.loc[header_idx + 1:]
+        width = len(header)
+        plan, code_col, diag_msg = resolve_resident_columns(header, first)
+
+    with phases.phase('load'): cur.execute("TRUNCATE TABLE raw_residents_csv RESTART IDENTITY")
+    count = 0
+    sample_codes = []
+    for chunk in phases.iterate('parse', itertools.chain([first], chunks)):
+        with phases.phase('normalize'):
+            chunk = chunk.reindex(columns=range(width))
+            clean = normalize_resident_chunk(chunk, plan, code_col)
+            if clean.empty: continue
+            if code_col is not None and len(sample_codes) < 5:
+                codes = clean['code'][clean['code'] != 0]
+                sample_codes += [str(c) for c in codes.head(5 - len(sample_codes))]
+        with phases.phase('load'): copy_residents_chunk(cur, clean)
+        count += len(clean)
+        job.update(done=count)
+    return count, diag_msg, sample_codes
+
+def load_residents(file, cur, job=NO_JOB, phases=None):
+    if RESIDENT_IMPORT_MODE == 'legacy': return load_residents_legacy(file, cur, job, phases)
+    return load_residents_stream(file, cur, job, phases)
+
+def import_residents_job(job, path, filename):
+    """קליטת קובץ תושבים כעבודת רקע, בטרנזקציה אחת: ביטול או שגיאה לא משאירים קליטה חלקית."""
+    with open(path, 'rb') as f, db_connection() as conn, job.attached(conn):
+        conn.autocommit = False
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        phases = PhaseTimer('import_residents')
+        job.update(phase='טעינת הקובץ')
+        loaded = load_residents(FileStorage(f, filename=filename), cur, job, phases)
+        if loaded is None: raise ValueError('לא ניתן לקרוא את הקובץ')
+        count, diag_msg, sample_codes = loaded
+        job.update(phase='שלב ביניים', done=count, total=count)
+        with phases.phase('stage'): cur.execute("SELECT raw_to_temp_stage()")
+        job.update(phase='עיבוד תושבים')
+        with phases.phase('merge'): cur.execute("SELECT process_residents_csv()")
+
+        # בדיקת מקסימום
+        cur.execute("SELECT MAX(personid) as m FROM person")
+        mx = cur.fetchone()['m']
+        conn.commit()
+        phases.record()
+    return [f'קובץ נקלט! {count} רשומות. {diag_msg}. (ID מקסימלי: {mx}, דוגמאות: {", ".join(sample_codes)})']
+
+# --- טעינת הזמנות חיצוניות ---
+ORDER_IMPORT_MODE = os.getenv("ORDER_IMPORT_MODE", "stream")
+OUTER_ORDER_BATCH_ROWS = 1000
+
+def load_outer_orders_legacy(file, cur, job=NO_JOB):
+    df = None
+    if file.filename.lower().endswith('.csv'):
+        try: file.seek(0); df = pd.read_csv(file, encoding='utf-8-sig')
+        except: file.seek(0); df = pd.read_csv(file, encoding='cp1255')
+    else: file.seek(0); df = pd.read_excel(file, engine='openpyxl')
+
+    clean, _ = extract_clean_data(df)
+    # שחזור הזמנות
+    df.columns = [str(c).strip().lower() for c in df.columns]
+    col_sender = next((c for c in df.columns if 'sender' in c or 'order_code' in c or 'code' in c or 'קוד' in c), None)
+    col_invitees = next((c for c in df.columns if 'invite' in c or 'guest' in c or 'מוזמנים' in c), None)
+    col_phone = next((c for c in df.columns if 'phone' in c or 'mobile' in c or 'טלפון' in c), None)
+
+    job.update(phase='קריאת שורות', total=len(df))
+    vals = []
+    for n, (_, row) in enumerate(df.iterrows()):
+        if n % 1000 == 0: job.update(done=n)
+        s = clean_int_str(row[col_sender]) if col_sender else ''
+        i = str(handle_series(row[col_invitees])) if col_invitees else ''
+        p = str(handle_series(row[col_phone])) if col_phone else None
+        if s or i: vals.append((s, i, 'סמלי', 'upload', p))
+
+    q = "INSERT INTO outerapporder (sender_code, invitees, package_size, origin, sender_phone) VALUES (%s, %s, %s, %s, %s)"
+    job.update(phase='כתיבה', done=0, total=len(vals))
+    for start in range(0, len(vals), OUTER_ORDER_BATCH_ROWS):
+        execute_batch(cur, q, vals[start:start + OUTER_ORDER_BATCH_ROWS])
+        job.update(done=min(start + OUTER_ORDER_BATCH_ROWS, len(vals)))
+    return len(vals), 0
+
+# קליטה בזרימה: chunks מהקובץ, ניקוי וקטורי לכל עמודה, COPY לטבלת ביניים ו-INSERT אחד עם דילוג על כפילויות
+# שם עמודה מדויק, לפי עדיפות. הטלפון מזוהה ראשון, כדי ש-sender_phone לא ייתפס כקוד שולח
+ORDER_FIELD_OPTIONS = {
+    'sender_phone': ['sender_phone', 'phone', 'mobile', 'טלפון', 'נייד', 'טלפון שולח'],
+    'invitees': ['invitees', 'guests', 'מוזמנים'],
+    'sender_code': ['sender_code', 'sender', 'order_code', 'code', 'קוד', 'קוד שולח', 'קוד מזמין'],
+}
+# אם אין שם מדויק: עמודה פנויה שהשם שלה מכיל אחד מאלה (כמו הזיהוי הישן)
+ORDER_FIELD_HINTS = {
+    'sender_phone': ['phone', 'mobile', 'טלפון', 'נייד'],
+    'invitees': ['invite', 'guest', 'מוזמנים'],
+    'sender_code': ['sender', 'order_code', 'code', 'קוד'],
+}
+OUTER_ORDER_COLUMNS = ['sender_code', 'invitees', 'sender_phone']
+
+def resolve_order_columns(header):
+    names = [clean_column_name(h) for h in header]
+    cols = {field: next((names.index(o) for o in options if o in names), None) for field, options in ORDER_FIELD_OPTIONS.items()}
+    taken = {c for c in cols.values() if c is not None}
+    for field, hints in ORDER_FIELD_HINTS.items():
+        if cols[field] is not None: continue
+        cols[field] = next((i for i, n in enumerate(names) if i not in taken and any(h in n for h in hints)), None)
+        if cols[field] is not None: taken.add(cols[field])
+    return cols
+
+def find_order_header(df):
+    # שורת הכותרת: הראשונה (מתוך 30) שיש בה שם עמודה מוכר
+    for i, row in df.head(30).iterrows():
+        if any(c is not None for c in resolve_order_columns(row.tolist()).values()): return i
+    return None
+
+def clean_int_column(s):
+    # מקבילה וקטורית ל-clean_int_str: ספרות ונקודה בלבד וקטימה למספר שלם; מה שלא מספר נשאר כמו שהוא, ריק = None
+    text = as_text(s).str.strip()
+    nums = pd.to_numeric(text.str.replace(r'[^\d.]', '', regex=True), errors='coerce')
+    nums = nums.where(nums.abs() < 1e18)
+    out = text.where(nums.isna(), nums.fillna(0).astype('int64').astype(str))
+    return out.where(text != '', None)
+
+def normalize_order_chunk(df, cols):
+    """גרסה וקטורית של הלולאה ב-load_outer_orders_legacy עבור chunk אחד."""
+    out = pd.DataFrame(index=df.index)
+    out['sender_code'] = clean_int_column(df[cols['sender_code']]) if cols['sender_code'] is not None else None
+    out['invitees'] = as_text(df[cols['invitees']]).str.strip() if cols['invitees'] is not None else ''
+    phone = as_text(df[cols['sender_phone']]).str.strip() if cols['sender_phone'] is not None else pd.Series('', index=df.index)
+    out['sender_phone'] = phone.where(phone != '', None)
+    return out[out['sender_code'].notna() | (out['invitees'] != '')]
+
+def load_outer_orders_stream(file, cur, job=NO_JOB):
+    """מחזיר (נוספו, כפולות שדולגו), או None אם לא ניתן לקרוא את הקובץ."""
+    chunks = read_table_chunks(file)
+    first = next(chunks, None) if chunks is not None else None
+    if first is None: return None
+    header_idx = find_order_header(first)
+    if header_idx is None: raise ValueError('לא זוהו עמודות הזמנה (קוד שולח / מוזמנים / טלפון)')
+    header = first.loc[header_idx].tolist()
+    cols = resolve_order_columns(header)
+
+    cur.execute("DROP TABLE IF EXISTS outer_upload")
+    cur.execute("CREATE TEMP TABLE outer_upload (line bigint GENERATED ALWAYS AS IDENTITY, sender_code text, invitees text, sender_phone text)")
+    job.update(phase='טעינת הקובץ')
+    staged = 0
+    for chunk in itertools.chain([first.loc[header_idx + 1:]], chunks):
+        clean = normalize_order_chunk(chunk.reindex(columns=range(len(header))), cols)
+        if clean.empty: continue
+        buf = io.StringIO()
+        clean.to_csv(buf, header=False, index=False, quoting=csv.QUOTE_ALL)
+        buf.seek(0)
+        cur.copy_expert(f"COPY outer_upload ({', '.join(OUTER_ORDER_COLUMNS)}) "
+                        "FROM STDIN WITH (FORMAT csv, FORCE_NULL (sender_code, sender_phone))", buf)
+        staged += len(clean)
+        job.update(done=staged)
+
+    # כפילויות (בתוך הקובץ ומול העלאות קודמות) נופלות על ux_outerapporder_content_hash
+    job.update(phase='הוספה לתור', total=staged)
+    cur.execute("""
+        INSERT INTO outerapporder (sender_code, invitees, package_size, origin, sender_phone, content_hash)
+        SELECT sender_code, invitees, 'סמלי', 'upload', sender_phone,
+               outer_order_hash(sender_code, invitees, sender_phone, 'סמלי')
+        FROM outer_upload ORDER BY line
+        ON CONFLICT (content_hash) DO NOTHING
+    """)
+    inserted = cur.rowcount
+    cur.execute("DROP TABLE outer_upload")
+    return inserted, staged - inserted
+
+def load_outer_orders(file, cur, job=NO_JOB):
+    if ORDER_IMPORT_MODE == 'legacy': return load_outer_orders_legacy(file, cur, job)
+    return load_outer_orders_stream(file, cur, job)
+
+def load_outer_orders_job(job, path, filename):
+    """טעינת קובץ הזמנות כעבודת רקע, בטרנזקציה אחת."""
+    with open(path, 'rb') as f, db_connection() as conn, job.attached(conn):
+        conn.autocommit = False
+        loaded = load_outer_orders(FileStorage(f, filename=filename), conn.cursor(), job)
+        if loaded is None: raise ValueError('לא ניתן לקרוא את הקובץ')
+        count, duplicates = loaded
+        conn.commit()
+    return [f'נטענו {count} הזמנות.' + (f' {duplicates} הזמנות כפולות דולגו.' if duplicates else '')]
+
+# --- מנוע הפצה (פייתון) ---
+HEADER_CODES = ('code', 'id', 'קוד', 'sender')
+DISTRIBUTION_WRITE_ROWS = 10000  # הזמנות לכל execute_values במנוע הפייתון (דיווח התקדמות בין קבוצות)
+
+# חיפוש תושב לפי טלפון מנורמל בשלוש העמודות (כל אחת עם אינדקס משלה)
+PHONE_LOOKUP_SQL = """
+    SELECT personid, phone_norm FROM person WHERE phone_norm = {keys}
+    UNION ALL SELECT personid, mobile_norm FROM person WHERE mobile_norm = {keys}
+    UNION ALL SELECT personid, mobile2_norm FROM person WHERE mobile2_norm = {keys}
+"""
+
+DISTRIBUTION_INSERT_SQL = """
+    INSERT INTO "Order" (delivery_sender_id, delivery_getter_id, price, origin_outer_id, order_date, origin_type, package_size)
+    VALUES %s
+    ON CONFLICT DO NOTHING
+    RETURNING id
+"""
+DISTRIBUTION_INSERT_TEMPLATE = "(%s, %s, %s, %s, CURRENT_DATE, 'invitees', 'סמלי')"
+
+def load_person_codes(cur):
+    cur.execute("SELECT personid FROM person")
+    return {str(p['personid']): p['personid'] for p in cur.fetchall()}
+
+def load_phone_map(cur, orders):
+    # מפת טלפונים: רק המספרים שמופיעים בהזמנות, דרך האינדקסים על עמודות ה-*_norm
+    phones = list({normalize_phone(o['sender_phone']) for o in orders if o['sender_phone']} - {None})
+    phone_map = {}
+    if phones:
+        cur.execute(PHONE_LOOKUP_SQL.format(keys='ANY(%(phones)s)') + " ORDER BY personid", {'phones': phones})
+        for p in cur.fetchall(): phone_map[p['phone_norm']] = p['personid']
+    return phone_map
+
+def distribution_price(cur):
+    cur.execute("SELECT setting_value FROM delivery_settings WHERE setting_name='delivery_price'")
+    res = cur.fetchone()
+    return float(res['setting_value']) if res else 10.0
+
+def match_outer_orders(orders, id_map, phone_map, price, job=NO_JOB):
+    """התאמת שולח ומוזמנים לכל הזמנה. מחזיר (הזמנות חדשות, עדכוני סטטוס, שגיאות, שגיאות לדוגמה)."""
+    new_orders = []
+    updates = []
+    errors = []
+    debug_sample = []
+
+    for i, o in enumerate(orders):
+        if i % 1000 == 0: job.update(done=i)
+        try:
+            sender_id = None
+            raw_code = clean_int_str(o['sender_code'])
         
-        cur.execute("SELECT setting_value FROM delivery_settings WHERE setting_name='delivery_price'")
-        res = cur.fetchone()
-        price = float(res['setting_value']) if res else 10.0
+            # 1. לפי קוד
+            if raw_code and raw_code in id_map:
+                sender_id = id_map[raw_code]
         
-        new_orders = []
-        updates = []
-        errors = []
-        debug_sample = []
-
-        for o in orders:
-            try:
-                sender_id = None
-                raw_code = clean_int_str(o['sender_code'])
-                
-                # 1. לפי קוד
-                if raw_code and raw_code in id_map:
-                    sender_id = id_map[raw_code]
-                
-                # 2. לפי טלפון
-                if not sender_id and o['sender_phone']:
-                    norm_p = normalize_phone(o['sender_phone'])
-                    if norm_p and norm_p in phone_map:
-                        sender_id = phone_map[norm_p]
-                
-                if not sender_id:
-                    if str(o['sender_code']).lower() in ['code', 'id', 'קוד', 'sender']: # כותרת
-                        updates.append((o['id'], 'error'))
-                        continue
-                    msg = f'שולח לא נמצא (קוד: {o["sender_code"]})'
-                    errors.append((o['id'], 'error', msg))
-                    if len(debug_sample) < 2: debug_sample.append(msg)
+            # 2. לפי טלפון
+            if not sender_id and o['sender_phone']:
+                norm_p = normalize_phone(o['sender_phone'])
+                if norm_p and norm_p in phone_map:
+                    sender_id = phone_map[norm_p]
+        
+            if not sender_id:
+                if str(o['sender_code']).lower() in HEADER_CODES: # כותרת
+                    updates.append((o['id'], 'error'))
                     continue
+                msg = f'שולח לא נמצא (קוד: {o["sender_code"]})'
+                errors.append((o['id'], 'error', msg))
+                if len(debug_sample) < 2: debug_sample.append(msg)
+                continue
 
-                # מוזמנים
-                raw_invitees = str(o['invitees']) if o['invitees'] else ''
-                tokens = re.split(r'[|,\s]+', raw_invitees)
-                valid_invitees = []
-                for t in tokens:
-                    cln = clean_int_str(t)
-                    if cln and cln in id_map:
-                        valid_invitees.append(id_map[cln])
-                
-                if not valid_invitees:
-                    errors.append((o['id'], 'error', 'אין מוזמנים תקינים'))
-                    continue
-                
-                for getter_id in valid_invitees:
-                    new_orders.append((sender_id, getter_id, price, o['id']))
-                updates.append((o['id'], 'distributed'))
-                
-            except Exception as e:
-                errors.append((o['id'], 'error', str(e)))
+            # מוזמנים
+            raw_invitees = str(o['invitees']) if o['invitees'] else ''
+            tokens = re.split(r'[|,\s]+', raw_invitees)
+            valid_invitees = []
+            for t in tokens:
+                cln = clean_int_str(t)
+                if cln and cln in id_map:
+                    valid_invitees.append(id_map[cln])
+        
+            if not valid_invitees:
+                errors.append((o['id'], 'error', 'אין מוזמנים תקינים'))
+                continue
+        
+            for getter_id in valid_invitees:
+                new_orders.append((sender_id, getter_id, price, o['id']))
+            updates.append((o['id'], 'distributed'))
+        
+        except Exception as e:
+            errors.append((o['id'], 'error', str(e)))
 
-        if new_orders:
-            insert_q = """
-            INSERT INTO "Order" (delivery_sender_id, delivery_getter_id, price, origin_outer_id, order_date, origin_type, package_size)
-            VALUES (%s, %s, %s, %s, CURRENT_DATE, 'invitees', 'סמלי')
-            ON CONFLICT DO NOTHING
-            """
-            execute_batch(cur, insert_q, new_orders)
-            total_orders = len(new_orders)
+    return new_orders, updates, errors, debug_sample
+
+def distribution_messages(total_orders, debug_sample):
+    if total_orders > 0: return [f"הפצה הושלמה! {total_orders} הזמנות נוצרו."]
+    messages = ["לא נוצרו הזמנות."]
+    if debug_sample: messages.append(f"שגיאות לדוגמה: {'; '.join(debug_sample)}")
+    return messages
+
+def distribute_in_python(job=NO_JOB):
+    with db_connection() as conn, job.attached(conn):
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        messages = []
+        total_orders = 0
+    
+        phases = PhaseTimer('distribute_python')
+        try:
+            # טעינת מפת תושבים (קוד)
+            job.update(phase='טעינת תושבים')
+            with phases.phase('load'):
+                id_map = load_person_codes(cur)
+
+                cur.execute("SELECT * FROM outerapporder WHERE status IN ('waiting', 'error')")
+                orders = cur.fetchall()
+                phone_map = load_phone_map(cur, orders)
+                price = distribution_price(cur)
+
+            job.update(phase='התאמת הזמנות', done=0, total=len(orders))
+            with phases.phase('match'):
+                new_orders, updates, errors, debug_sample = match_outer_orders(orders, id_map, phone_map, price, job)
+
+            if new_orders:
+                # סופרים רק שורות שנוספו בפועל (כפילויות נדחות ע"י ux_order_sender_getter_origin)
+                job.update(phase='כתיבת הזמנות', done=0, total=len(new_orders))
+                with phases.phase('write'):
+                    for i in range(0, len(new_orders), DISTRIBUTION_WRITE_ROWS):
+                        inserted = execute_values(cur, DISTRIBUTION_INSERT_SQL, new_orders[i:i + DISTRIBUTION_WRITE_ROWS],
+                                                  template=DISTRIBUTION_INSERT_TEMPLATE, fetch=True)
+                        total_orders += len(inserted)
+                        job.update(done=min(i + DISTRIBUTION_WRITE_ROWS, len(new_orders)))
         
-        for uid, status in updates:
-            cur.execute("UPDATE outerapporder SET status=%s, processed_at=NOW(), error_message=NULL WHERE id=%s", (status, uid))
-        for uid, status, msg in errors:
-            cur.execute("UPDATE outerapporder SET status=%s, processed_at=NOW(), error_message=%s WHERE id=%s", (status, msg, uid))
-            cur.execute("INSERT INTO outerapporder_error_log (outer_id, message) VALUES (%s, %s)", (uid, msg))
-
-        if total_orders > 0:
-            messages.append(f"הפצה הושלמה! {total_orders} הזמנות נוצרו.")
-        else:
-            messages.append("לא נוצרו הזמנות.")
-            if debug_sample: messages.append(f"שגיאות לדוגמה: {'; '.join(debug_sample)}")
+            job.update(phase='עדכון סטטוס', done=0, total=len(updates) + len(errors))
+            with phases.phase('status'):
+                for i, (uid, status) in enumerate(updates):
+                    if i % 1000 == 0: job.update(done=i)
+                    cur.execute("UPDATE outerapporder SET status=%s, processed_at=NOW(), error_message=NULL WHERE id=%s", (status, uid))
+                for uid, status, msg in errors:
+                    cur.execute("UPDATE outerapporder SET status=%s, processed_at=NOW(), error_message=%s WHERE id=%s", (status, msg, uid))
+                    cur.execute("INSERT INTO outerapporder_error_log (outer_id, message) VALUES (%s, %s)", (uid, msg))
+
+            messages = distribution_messages(total_orders, debug_sample)
+            phases.record()
             
-    except Exception as e:
-        messages.append(f"Error: {e}")
-    
-    conn.close()
+        except (JobCancelled, psycopg2.extensions.QueryCanceledError):
+            raise
+        except Exception as e:
+            messages.append(f"Error: {e}")
+
     return total_orders, messages
 
-def auto_fix_database(cur):
+# --- מנוע הפצה (SQL, פעולות על קבוצות) ---
+def sql_clean_int(col):
+    # מקבילה ב-SQL ל-clean_int_str: ספרות ונקודה בלבד, קטימה למספר שלם (NULL אם לא מספר)
+    digits = f"regexp_replace({col}, '[^0-9.]', '', 'g')"
+    return (f"CASE WHEN {digits} ~ '^([0-9]{{1,18}}(\\.[0-9]*)?|\\.[0-9]+)$' "
+            f"THEN COALESCE(NULLIF(split_part({digits}, '.', 1), ''), '0')::bigint END")
+
+def distribute_in_sql(job=NO_JOB):
+    """אותה הפצה כמו distribute_in_python, אבל כמה פקודות על קבוצות בטרנזקציה אחת."""
+    with db_connection() as conn, job.attached(conn):
+        conn.autocommit = False
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        messages = []
+        total_orders = 0
+
+        try:
+            price = distribution_price(cur)
+
+            # 1. שלב ביניים: כל ההזמנות הממתינות עם קוד וטלפון מנורמלים
+            job.update(phase='שלב ביניים')
+            cur.execute(f"""
+                CREATE TEMP TABLE dist_orders ON COMMIT DROP AS
+                SELECT o.id, o.sender_code, o.invitees,
+                       {sql_clean_int('o.sender_code')} AS code_num,
+                       format_il_phone(o.sender_phone) AS phone_norm,
+                       NULL::int AS sender_id, NULL::text AS result, NULL::text AS error_message
+                FROM outerapporder o
+                WHERE o.status IN ('waiting', 'error')
+            """)
+            pending = cur.rowcount
+            job.update(total=pending)
+            cur.execute("ANALYZE dist_orders")
+
+            # 2. שולח לפי קוד, ואחר כך לפי טלפון
+            job.update(phase='התאמת שולחים')
+            cur.execute("UPDATE dist_orders d SET sender_id = p.personid FROM person p WHERE p.personid = d.code_num")
+            cur.execute(f"""
+                UPDATE dist_orders d SET sender_id = (
+                    SELECT MAX(ph.personid) FROM ({PHONE_LOOKUP_SQL.format(keys='d.phone_norm')}) ph)
+                WHERE d.sender_id IS NULL AND d.phone_norm IS NOT NULL
+            """)
+
+            # 3. פירוק המוזמנים לשורות והתאמה לתושבים
+            job.update(phase='התאמת מוזמנים')
+            cur.execute(f"""
+                CREATE TEMP TABLE dist_invitees ON COMMIT DROP AS
+                SELECT d.id AS outer_id, d.sender_id, p.personid AS getter_id, t.ord
+                FROM dist_orders d
+                CROSS JOIN LATERAL regexp_split_to_table(COALESCE(d.invitees, ''), '[|,\\s]+')
+                    WITH ORDINALITY AS t(token, ord)
+                JOIN person p ON p.personid = {sql_clean_int('t.token')}
+                WHERE d.sender_id IS NOT NULL
+            """)
+            cur.execute("CREATE INDEX ON dist_invitees (outer_id)")
+            cur.execute("ANALYZE dist_invitees")
+
+            # 4. סיווג כל הזמנה
+            cur.execute("""
+                UPDATE dist_orders d SET
+                    result = CASE
+                        WHEN d.sender_id IS NULL AND lower(d.sender_code) = ANY(%(headers)s) THEN 'header'
+                        WHEN d.sender_id IS NULL THEN 'missing_sender'
+                        WHEN NOT EXISTS (SELECT 1 FROM dist_invitees i WHERE i.outer_id = d.id) THEN 'no_invitees'
+                        ELSE 'distributed' END,
+                    error_message = CASE
+                        WHEN d.sender_id IS NULL AND lower(d.sender_code) = ANY(%(headers)s) THEN NULL
+                        WHEN d.sender_id IS NULL THEN format('שולח לא נמצא (קוד: %%s)', COALESCE(d.sender_code, 'None'))
+                        WHEN NOT EXISTS (SELECT 1 FROM dist_invitees i WHERE i.outer_id = d.id) THEN 'אין מוזמנים תקינים'
+                        END
+            """, {'headers': list(HEADER_CODES)})
+
+            # 5. כתיבה מרוכזת
+            job.update(phase='כתיבת הזמנות')
+            cur.execute("""
+                INSERT INTO "Order" (delivery_sender_id, delivery_getter_id, price, origin_outer_id, order_date, origin_type, package_size)
+                SELECT sender_id, getter_id, %s, outer_id, CURRENT_DATE, 'invitees', 'סמלי'
+                FROM dist_invitees ORDER BY outer_id, ord
+                ON CONFLICT DO NOTHING
+            """, (price,))
+            total_orders = max(cur.rowcount, 0)
+
+            cur.execute("""
+                UPDATE outerapporder o
+                SET status = CASE WHEN d.result = 'distributed' THEN 'distributed' ELSE 'error' END,
+                    processed_at = NOW(), error_message = d.error_message
+                FROM dist_orders d WHERE o.id = d.id
+            """)
+            cur.execute("""
+                INSERT INTO outerapporder_error_log (outer_id, message)
+                SELECT id, error_message FROM dist_orders WHERE error_message IS NOT NULL ORDER BY id
+            """)
+            cur.execute("SELECT error_message FROM dist_orders WHERE result = 'missing_sender' ORDER BY id LIMIT 2")
+            debug_sample = [r['error_message'] for r in cur.fetchall()]
+            job.update(phase='סיום', done=pending)
+            conn.commit()
+            messages = distribution_messages(total_orders, debug_sample)
+
+        except (JobCancelled, psycopg2.extensions.QueryCanceledError):
+            conn.rollback()
+            raise
+        except Exception as e:
+            conn.rollback()
+            total_orders = 0
+            messages.append(f"Error: {e}")
+
+    return total_orders, messages
+
+# --- מנוע הפצה מקבילי (תהליכים) ---
+# ההזמנות הממתינות מחולקות לטווחי id (shards). כל shard מותאם ונכתב בתהליך נפרד עם חיבור משלו, בטרנזקציה אחת:
+# תהליך שנופל משאיר את ה-shard שלו ממתין (rollback), אף פעם לא חצי מופץ.
+DISTRIBUTION_WORKERS = int(os.getenv("DISTRIBUTION_WORKERS", str(os.cpu_count() or 1)))
+DISTRIBUTION_SHARD_ROWS = int(os.getenv("DISTRIBUTION_SHARD_ROWS", "20000"))
+DISTRIBUTION_SHARD_RETRIES = 1  # סבבים נוספים ל-shards שנכשלו כי תהליך מת (BrokenProcessPool)
+DISTRIBUTION_SHARD_ATTEMPTS = 3  # ניסיונות ל-shard שנפל על deadlock מול shard אחר
+DISTRIBUTION_RETRY_LOCK_TIMEOUT = '60s'  # בסבב חוזר: כמה לחכות שהחיבור של תהליך שמת ישחרר את השורות
+shard_person_codes = None  # מפת הקודים של התהליך, נטענת פעם אחת ב-init_shard_worker
+
+def init_shard_worker():
+    global shard_person_codes
+    with db_cursor() as cur: shard_person_codes = load_person_codes(cur)
+
+def distribute_shard(first_id, last_id, price, wait_locked=False):
+    """מפיץ את ההזמנות הממתינות בטווח [first_id, last_id]. מחזיר (הזמנות שנתפסו, הזמנות שנוצרו, שגיאות לדוגמה).
+    wait_locked: לחכות לשורות נעולות במקום לדלג עליהן (סבב חוזר אחרי תהליך שמת)."""
+    for attempt in range(DISTRIBUTION_SHARD_ATTEMPTS):
+        try:
+            return distribute_shard_once(first_id, last_id, price, wait_locked)
+        except psycopg2.errors.DeadlockDetected:
+            if attempt == DISTRIBUTION_SHARD_ATTEMPTS - 1: raise
+
+def distribute_shard_once(first_id, last_id, price, wait_locked):
+    with db_connection() as conn:
+        conn.autocommit = False
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        # SKIP LOCKED: שורות שמישהו אחר כבר מחזיק לא נתפסות פעמיים. אחרי תהליך שמת החיבור שלו עלול להחזיק
+        # אותן עוד זמן מה (עד שהפקודה שלו נגמרת ו-rollback), ולכן בסבב חוזר מחכים להן
+        if wait_locked: cur.execute("SET LOCAL lock_timeout = %s", (DISTRIBUTION_RETRY_LOCK_TIMEOUT,))
+        cur.execute(f"""
+            SELECT * FROM outerapporder
+            WHERE id BETWEEN %s AND %s AND status IN ('waiting', 'error')
+            ORDER BY id FOR UPDATE{'' if wait_locked else ' SKIP LOCKED'}
+        """, (first_id, last_id))
+        orders = cur.fetchall()
+        new_orders, updates, errors, debug_sample = match_outer_orders(
+            orders, shard_person_codes, load_phone_map(cur, orders), price)
+
+        created = 0
+        if new_orders:
+            # פקודת INSERT אחת ל-shard: ה-trigger של הסיכומים (מיגרציה 0006) רץ פעם אחת ונועל את שורות הסיכום
+            # בסדר קבוע, כך ש-shards במקביל ממתינים זה לזה בשלב הזה בלבד ולא נתקעים ב-deadlock
+            created = len(execute_values(cur, DISTRIBUTION_INSERT_SQL, new_orders, template=DISTRIBUTION_INSERT_TEMPLATE,
+                                         page_size=len(new_orders), fetch=True))
+        statuses = [(uid, status, None) for uid, status in updates] + errors
+        if statuses:
+            execute_values(cur, """
+                UPDATE outerapporder o SET status = v.status, processed_at = NOW(), error_message = v.msg
+                FROM (VALUES %s) v(id, status, msg) WHERE o.id = v.id
+            """, statuses, page_size=DISTRIBUTION_WRITE_ROWS)
+        if errors:
+            execute_values(cur, "INSERT INTO outerapporder_error_log (outer_id, message) VALUES %s",
+                           [(uid, msg) for uid, _, msg in errors], page_size=DISTRIBUTION_WRITE_ROWS)
+        conn.commit()
+    return len(orders), created, debug_sample
+
+def distribute_in_parallel(job=NO_JOB, workers=None):
+    """אותה הפצה כמו distribute_in_python, מפוצלת ל-shards שרצים ב-process pool."""
+    workers = workers or DISTRIBUTION_WORKERS
+    with db_cursor() as cur:
+        price = distribution_price(cur)
+        job.update(phase='חלוקה ל-shards')
+        cur.execute("""
+            SELECT min(id) AS first_id, max(id) AS last_id, count(*) AS n
+            FROM (SELECT id, (row_number() OVER (ORDER BY id) - 1) / %s AS shard
+                  FROM outerapporder WHERE status IN ('waiting', 'error')) s
+            GROUP BY shard ORDER BY shard
+        """, (DISTRIBUTION_SHARD_ROWS,))
+        shards = cur.fetchall()
+    if not shards: return 0, distribution_messages(0, [])
+
+    job.update(phase='הפצה מקבילית', done=0, total=sum(s['n'] for s in shards))
+    done, results, pending = 0, {}, list(range(len(shards)))
+    for attempt in range(DISTRIBUTION_SHARD_RETRIES + 1):
+        if attempt: job.update(phase=f'הפצה מקבילית (ניסיון {attempt + 1})')
+        # spawn ולא fork: התהליך הראשי מריץ threads (בקשות, עבודות רקע) ו-fork עלול לרשת מנעולים תפוסים
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending)), mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=init_shard_worker) as pool:
+            futures = {pool.submit(distribute_shard, shards[i]['first_id'], shards[i]['last_id'], price, attempt > 0): i
+                       for i in pending}
+            try:
+                for f in as_completed(futures):
+                    i = futures[f]
+                    try:
+                        results[i] = f.result()
+                    except Exception as e:
+                        results[i] = e
+                    else:
+                        done += shards[i]['n']
+                        job.update(done=done)
+            except JobCancelled:
+                # shards שכבר רצים מסתיימים (ונשמרים), השאר לא מתחילים
+                pool.shutdown(cancel_futures=True)
+                raise
+        # תהליך שמת שובר את כל ה-pool, גם ל-shards שרק חיכו בתור. שגיאה בתוך shard תחזור גם בניסיון נוסף
+        pending = [i for i in pending if isinstance(results[i], BrokenProcessPool)]
+        if not pending: break
+
+    ok = [results[i] for i in sorted(results) if not isinstance(results[i], Exception)]
+    failed = [r for r in results.values() if isinstance(r, Exception)]
+    total_orders = sum(created for _, created, _ in ok)
+    messages = distribution_messages(total_orders, [m for _, _, sample in ok for m in sample][:2])
+    skipped = sum(shards[i]['n'] - results[i][0] for i in results if not isinstance(results[i], Exception))
+    if skipped > 0: messages.append(f"{skipped} הזמנות היו נעולות ע\"י תהליך אחר ודולגו; הן נשארו ממתינות.")
+    if failed:
+        messages.append(f"{len(failed)} מתוך {len(shards)} חלקים נכשלו ({failed[0]!r}); "
+                        "ההזמנות שלהם נשארו ממתינות - אפשר להריץ הפצה שוב.")
+    return total_orders, messages
+
+DISTRIBUTION_MODE = os.getenv("DISTRIBUTION_MODE", "sql")
+DISTRIBUTION_LOCK_ID = 48151624  # pg_try_advisory_lock: הפצה אחת בכל רגע, גם בין תהליכים
+DISTRIBUTION_BUSY = "הפצה אחרת כבר רצה - נסה שוב כשתסתיים"
+
+def distribute_orders(job=NO_JOB):
     try:
-        cur.execute("DROP INDEX IF EXISTS public.ux_person_unique_phone_address;")
-        cur.execute("ALTER TABLE public.temp_residents_csv ADD COLUMN IF NOT EXISTS code integer;")
-        cur.execute("ALTER TABLE public.outerapporder ADD COLUMN IF NOT EXISTS sender_phone text;")
-        cur.execute("INSERT INTO public.street (streetcode, streetname) VALUES (999, 'רחוב כללי') ON CONFLICT (streetcode) DO NOTHING;")
-        
-        cur.execute(r"""
-        CREATE OR REPLACE FUNCTION "public"."raw_to_temp_stage"() RETURNS "void" LANGUAGE "plpgsql" AS $func$
-        BEGIN
-          TRUNCATE TABLE public.temp_residents_csv RESTART IDENTITY;
-          INSERT INTO public.street (streetname)
-          SELECT DISTINCT TRIM(r.streetname) FROM public.raw_residents_csv r
-          WHERE TRIM(r.streetname) IS NOT NULL AND TRIM(r.streetname) <> ''
-            AND NOT EXISTS (SELECT 1 FROM public.street s WHERE TRIM(s.streetname) = TRIM(r.streetname));
-          INSERT INTO public.temp_residents_csv (code, lastname, father_name, mother_name, streetname, streetcode, buildingnumber, entrance, apartmentnumber, email, phone, mobile, mobile2, standing_order)
-          SELECT NULLIF(regexp_replace(r.code, '[^0-9]', '', 'g'), '')::int, TRIM(r.lastname), TRIM(r.father_name), TRIM(r.mother_name), TRIM(r.streetname), s.streetcode, TRIM(r.buildingnumber), TRIM(r.entrance), TRIM(r.apartmentnumber), normalize_email(r.email), format_il_phone(r.phone), format_il_phone(r.mobile), format_il_phone(r.mobile2), r.standing_order
-          FROM public.raw_residents_csv r LEFT JOIN public.street s ON TRIM(s.streetname) = TRIM(r.streetname);
-        END;
-        $func$;
-        """)
-        
-        cur.execute(r"""
-        CREATE OR REPLACE FUNCTION "public"."process_residents_csv"() RETURNS "void" LANGUAGE "plpgsql" AS $func$
-        DECLARE
-            rec RECORD; existing_person INT; target_id INT;
-        BEGIN
-            -- שינוי: הקפצת המונה ל-100,000 כדי לא להתנגש עם קודים ידניים (1-5000)
-            PERFORM setval('public.person_personid_seq', GREATEST((SELECT COALESCE(MAX(personid), 0) + 1 FROM public.person), 100000), false);
-            
-            FOR rec IN SELECT * FROM temp_residents_csv LOOP
-                target_id := rec.code; existing_person := NULL;
-                IF target_id IS NOT NULL THEN SELECT personid INTO existing_person FROM person WHERE personid = target_id; END IF;
-                IF existing_person IS NULL THEN SELECT personid INTO existing_person FROM person WHERE format_il_phone(phone) = format_il_phone(rec.phone) LIMIT 1; END IF;
-                IF existing_person IS NOT NULL THEN
-                    UPDATE person SET lastname = COALESCE(rec.lastname, lastname), email = COALESCE(rec.email, email), standing_order = COALESCE(rec.standing_order, standing_order), streetcode = COALESCE(rec.streetcode, streetcode) WHERE personid = existing_person;
-                    UPDATE temp_residents_csv SET status = 'עודכן' WHERE temp_id = rec.temp_id;
-                ELSE
-                    IF target_id IS NOT NULL THEN
-                        INSERT INTO person(personid, lastname, father_name, mother_name, streetcode, buildingnumber, entrance, apartmentnumber, phone, mobile, mobile2, email, standing_order) VALUES (target_id, rec.lastname, rec.father_name, rec.mother_name, rec.streetcode, rec.buildingnumber, rec.entrance, rec.apartmentnumber, rec.phone, rec.mobile, rec.mobile2, rec.email, rec.standing_order) ON CONFLICT (personid) DO UPDATE SET lastname = EXCLUDED.lastname;
-                        -- אין צורך לעדכן מונה כאן כי אנחנו משתמשים ב-ID ידני
-                    ELSE
-                        -- שימוש במונה האוטומטי (שכוון ל-100,000)
-                        INSERT INTO person(lastname, father_name, mother_name, streetcode, buildingnumber, entrance, apartmentnumber, phone, mobile, mobile2, email, standing_order) VALUES (rec.lastname, rec.father_name, rec.mother_name, rec.streetcode, rec.buildingnumber, rec.entrance, rec.apartmentnumber, rec.phone, rec.mobile, rec.mobile2, rec.email, rec.standing_order);
-                    END IF;
-                    UPDATE temp_residents_csv SET status = 'נוסף' WHERE temp_id = rec.temp_id;
-                END IF;
-            END LOOP;
-        END;
-        $func$;
+        with db_connection() as lock_conn:
+            lock = lock_conn.cursor()
+            lock.execute("SELECT pg_try_advisory_lock(%s)", (DISTRIBUTION_LOCK_ID,))
+            if not lock.fetchone()[0]: return 0, [DISTRIBUTION_BUSY]
+            try:
+                if DISTRIBUTION_MODE == 'python': return distribute_in_python(job)
+                if DISTRIBUTION_MODE == 'parallel': return distribute_in_parallel(job)
+                return distribute_in_sql(job)
+            finally:
+                lock.execute("SELECT pg_advisory_unlock(%s)", (DISTRIBUTION_LOCK_ID,))
+    except psycopg2.extensions.QueryCanceledError:
+        raise
+    except (PoolTimeout, psycopg2.OperationalError):
+        return 0, ["שגיאת חיבור"]
+
+def distribute_job(job):
+    cnt, msgs = distribute_orders(job)
+    if msgs == [DISTRIBUTION_BUSY]: raise RuntimeError(DISTRIBUTION_BUSY)
+    return msgs
+
+# --- autoreturn מרוכז ---
+# החזרה חסרה = מישהו שלח למשפחה והמשפחה עוד לא שלחה לו (בשום סוג מקור). פקודת INSERT אחת לכל המשפחות,
+# במקום apply_autoreturn_for שמכניסה שורה-שורה למשפחה אחת.
+AUTORETURN_MISSING_SQL = """
+    SELECT DISTINCT o.delivery_getter_id AS sender_id, o.delivery_sender_id AS getter_id
+    FROM "Order" o
+    JOIN person p ON p.personid = o.delivery_getter_id
+    WHERE {families} AND o.delivery_sender_id IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM "Order" r
+                      WHERE r.delivery_sender_id = o.delivery_getter_id AND r.delivery_getter_id = o.delivery_sender_id)
+"""
+
+def run_autoreturn(family_id=None, dry_run=False):
+    """יוצר את ההחזרות החסרות לכל המשפחות עם autoreturn (או למשפחה אחת). מחזיר (משפחות, הזמנות).
+    dry_run: רק סופר מה היה נוצר."""
+    families = "p.personid = %(family_id)s" if family_id is not None else "p.autoreturn"
+    missing = AUTORETURN_MISSING_SQL.format(families=families)
+    with db_cursor() as cur:
+        if dry_run:
+            cur.execute(f"SELECT count(DISTINCT sender_id) AS families, count(*) AS orders FROM ({missing}) m",
+                        {'family_id': family_id})
+        else:
+            cur.execute(f"""
+                WITH created AS (
+                    INSERT INTO "Order" (delivery_sender_id, delivery_getter_id, price, order_date, origin_type, package_size)
+                    SELECT m.sender_id, m.getter_id,
+                           COALESCE((SELECT setting_value FROM delivery_settings WHERE setting_name = 'delivery_price' LIMIT 1), 10.00),
+                           CURRENT_DATE, 'autoreturn', 'סמלי'
+                    FROM ({missing}) m ORDER BY m.sender_id, m.getter_id
+                    ON CONFLICT DO NOTHING
+                    RETURNING delivery_sender_id)
+                SELECT count(DISTINCT delivery_sender_id) AS families, count(*) AS orders FROM created
+            """, {'family_id': family_id})
+        res = cur.fetchone()
+    if res['orders'] and not dry_run: invalidate_dashboard_stats()
+    return res['families'], res['orders']
+
+def autoreturn_message(families, orders, dry_run):
+    if dry_run: return f"בדיקה: חסרות {orders} הזמנות החזרה ל-{families} משפחות (לא נוצר דבר)."
+    return f"autoreturn הושלם! {orders} הזמנות החזרה נוצרו ל-{families} משפחות."
+
+@app.cli.command('autoreturn')
+@click.option('--dry-run', is_flag=True, help='רק סופר את ההחזרות החסרות, בלי ליצור הזמנות.')
+def autoreturn_command(dry_run):
+    """יוצר הזמנות החזרה לכל המשפחות עם autoreturn."""
+    families, orders = run_autoreturn(dry_run=dry_run)
+    print(f"{orders} return orders {'missing' if dry_run else 'created'} for {families} families")
+
+# --- מיגרציות סכמה ---
+# קבצי migrations/NNNN_name.sql רצים פעם אחת, לפי הסדר, כל אחד בטרנזקציה משלו,
+# והגרסה נרשמת ב-schema_migrations. רצים בעליית האפליקציה או ב-flask --app app migrate.
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATIONS_LOCK_ID = 48151623  # pg_advisory_lock: שני תהליכים שעולים יחד לא מריצים אותה מיגרציה פעמיים
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "1") == "1"
+
+def list_migrations():
+    found = []
+    for name in sorted(os.listdir(MIGRATIONS_DIR)):
+        m = re.match(r'^(\d+)_(\w+)\.sql$', name)
+        if m: found.append((int(m.group(1)), m.group(2), os.path.join(MIGRATIONS_DIR, name)))
+    return found
+
+def run_migrations(conn):
+    """מחיל את המיגרציות שעוד לא נרשמו ב-schema_migrations ומחזיר את הגרסאות שהוחלו."""
+    applied = []
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+    try:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS public.schema_migrations (
+                version integer PRIMARY KEY,
+                name text NOT NULL,
+                applied_at timestamp with time zone NOT NULL DEFAULT now())
         """)
-    except: pass
+        cur.execute("SELECT version FROM public.schema_migrations")
+        done = {r[0] for r in cur.fetchall()}
+        for version, name, path in list_migrations():
+            if version in done: continue
+            with open(path, encoding='utf-8') as f: sql = f.read()
+            conn.autocommit = False
+            try:
+                cur.execute(sql)
+                cur.execute("INSERT INTO public.schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.autocommit = True
+            applied.append((version, name))
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+        cur.close()
+    return applied
+
+def migrate():
+    with db_connection() as conn:
+        applied = run_migrations(conn)
+    for version, name in applied: print(f"migration {version:04d}_{name} applied")
+    return applied
+
+@app.cli.command('migrate')
+def migrate_command():
+    """מחיל מיגרציות סכמה שעוד לא הורצו."""
+    if not migrate(): print("schema is up to date")
+
+# --- סיכומי הזמנות ---
+# person_order_totals / building_order_totals מתעדכנות בטריגרים על "Order" ו-person (מיגרציה 0006),
+# והדוחות קוראים מהן. הבדיקה משווה אותן לאותו חישוב מאפס (ה-views v_*_live).
+ORDER_TOTALS = {
+    'person_order_totals': ('v_person_order_totals_live', ['personid'],
+                            ['sent', 'sent_amount', 'received', 'received_regular', 'received_autoreturn',
+                             'received_symbolic', 'received_respectable', 'received_fancy']),
+    'building_order_totals': ('v_building_order_totals_live', ['streetcode', 'buildingnumber'],
+                              ['total_orders', 'symbolic_count', 'respectable_count', 'fancy_count']),
+}
+
+def check_order_totals(cur):
+    """מחזיר {טבלה: שורות שונות} - side='stored' מה ששמור, side='expected' מה שאמור להיות. ריק = עקבי."""
+    diffs = {}
+    # תמונת מצב אחת לשני הצדדים, כדי שהפצה שרצה במקביל לא תיראה כהפרש
+    cur.execute("BEGIN ISOLATION LEVEL REPEATABLE READ READ ONLY")
+    try:
+        for table, (live, keys, values) in ORDER_TOTALS.items():
+            cols = ', '.join(keys + values)
+            stored = f"SELECT {cols} FROM public.{table} WHERE {' OR '.join(f'{v} <> 0' for v in values)}"
+            cur.execute(f"""
+                SELECT 'stored' AS side, * FROM ({stored} EXCEPT SELECT {cols} FROM public.{live}) s
+                UNION ALL
+                SELECT 'expected', * FROM (SELECT {cols} FROM public.{live} EXCEPT {stored}) e
+                ORDER BY 2, 3, 1
+            """)
+            rows = cur.fetchall()
+            if rows: diffs[table] = rows
+    finally:
+        cur.execute("COMMIT")
+    return diffs
+
+@app.cli.command('check-totals')
+@click.option('--fix', is_flag=True, help='בונה מחדש את טבלאות הסיכום אם נמצאו הפרשים.')
+def check_totals_command(fix):
+    """משווה את טבלאות הסיכום לחישוב מאפס מ-"Order" ומדפיס הפרשים."""
+    with db_cursor() as cur:
+        diffs = check_order_totals(cur)
+        for table, rows in diffs.items():
+            print(f"{table}: {len(rows)} mismatched rows")
+            for r in rows[:20]: print("  " + ", ".join(f"{k}={v}" for k, v in r.items()))
+        if not diffs: print("order totals are consistent")
+        elif fix:
+            cur.execute("SELECT rebuild_order_totals()")
+            print("order totals rebuilt")
+    if diffs and not fix: raise SystemExit(1)
+
+# --- דוחות: דפדוף keyset וחיפוש ---
+# לכל דוח: מפתח מיון ייחודי (ביטויים על עמודות ה-view), כיוון ותנאי חיפוש.
+# עמוד הבא = WHERE (מפתח) > (המפתח של השורה האחרונה), כך שכל עמוד עולה אותו דבר בלי OFFSET.
+# רק views מהרשימה הזו זמינים לדוחות ולייצוא: שם ה-view נכנס לשאילתה, אז לא מקבלים שם שרירותי מה-URL.
+REPORT_PAGE_SIZE = int(os.getenv("REPORT_PAGE_SIZE", "50"))
+NAME_SEARCH = "lastname LIKE %(search)s"
+REPORT_PAGING = {
+    'v_accounts_summary': {'key': ["COALESCE(sender_name, '')", 'sender_id'], 'search': "sender_name LIKE %(search)s"},
+    'v_families_balance': {'key': ["COALESCE(lastname, '')", 'personid'], 'search': NAME_SEARCH},
+    'v_orders_details': {'key': ['id'], 'desc': True,
+                         # שם שולח או מקבל: דרך אינדקס ה-trigram על person ואז האינדקסים של "Order"
+                         'search': """id IN (SELECT o.id FROM person p JOIN "Order" o ON o.delivery_sender_id = p.personid WHERE p.lastname LIKE %(search)s
+                                             UNION SELECT o.id FROM person p JOIN "Order" o ON o.delivery_getter_id = p.personid WHERE p.lastname LIKE %(search)s)"""},
+    # ה-view מקבץ לפי (streetname, buildingnumber), ו-NULL הוא קבוצה נפרדת מ-'': ה-IS NULL שומר על מפתח ייחודי
+    'v_packages_per_building': {'key': ["COALESCE(streetname, '')", 'streetname IS NULL', "COALESCE(buildingnumber, '')", 'buildingnumber IS NULL'],
+                                'search': "streetname LIKE %(search)s"},
+    'v_family_receipts': {'key': ["COALESCE(lastname, '')", 'personid'], 'search': NAME_SEARCH},
+    # הסדר של ה-view לפני 0005 (רחוב, בניין, משפחה), עם personid כשובר שוויון
+    'v_residents_by_street': {'key': ["COALESCE(streetname, '')", "COALESCE(buildingnumber, '')", "COALESCE(lastname, '')", 'personid'],
+                              'search': "streetname LIKE %(search)s OR lastname LIKE %(search)s"},
+    'v_autoreturn_activity': {'key': ['order_id'], 'desc': True},
+    'v_orders_summary': {'key': ['sender_id', 'getter_id']},
+    'v_outer_distribution_status': {'key': ['id'], 'desc': True},
+    'v_outerapporder_full_summary': {'key': ['id'], 'desc': True},
+    'v_outer_errors_summary': {'key': ['id'], 'desc': True},
+}
+REPORT_VIEWS = tuple(REPORT_PAGING)
+
+def report_order_by(view_name, reverse=False):
+    cfg = REPORT_PAGING[view_name]
+    direction = 'DESC' if cfg.get('desc', False) != reverse else 'ASC'
+    return ', '.join(f'{k} {direction}' for k in cfg['key'])
+
+def encode_page_key(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+def decode_page_key(token, view_name):
+    # מפתח לא תקין (נערך ידנית/ישן) = חזרה לעמוד הראשון
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return values if isinstance(values, list) and len(values) == len(REPORT_PAGING[view_name]['key']) else None
+    except (ValueError, TypeError):
+        return None
+
+def report_page(cur, view_name, search='', after=None, before=None):
+    """עמוד אחד של דוח. after/before = מפתח השורה האחרונה/הראשונה בעמוד הנוכחי. מחזיר dict לתבנית."""
+    cfg = REPORT_PAGING[view_name]
+    keys = cfg['key']
+    where, params = [], {}
+    if search and cfg.get('search'):
+        where.append(f"({cfg['search']})")
+        params['search'] = f'%{search}%'
+    filter_sql = f" WHERE {' AND '.join(where)}" if where else ''
+
+    backwards = before is not None
+    anchor = before if backwards else after
+    if anchor is not None:
+        op = '<' if cfg.get('desc', False) != backwards else '>'
+        params.update({f'k{i}': v for i, v in enumerate(anchor)})
+        where.append(f"({', '.join(keys)}) {op} ({', '.join(f'%(k{i})s' for i in range(len(keys)))})")
+    page_sql = f" WHERE {' AND '.join(where)}" if where else ''
+
+    key_cols = ', '.join(f'{k} AS _k{i}' for i, k in enumerate(keys))
+    cur.execute(f'SELECT *, {key_cols} FROM "{view_name}"{page_sql} ORDER BY {report_order_by(view_name, backwards)} LIMIT %(limit)s',
+                dict(params, limit=REPORT_PAGE_SIZE + 1))
+    rows = cur.fetchall()
+    columns = [d.name for d in cur.description if not d.name.startswith('_k')]
+    more = len(rows) > REPORT_PAGE_SIZE
+    rows = rows[:REPORT_PAGE_SIZE]
+    if backwards: rows.reverse()
+    page_keys = [[r.pop(f'_k{i}') for i in range(len(keys))] for r in rows]
+
+    # הערכת כמות מהמתכנן במקום COUNT(*) על כל ה-view
+    cur.execute(f'EXPLAIN (FORMAT JSON) SELECT 1 FROM "{view_name}"{filter_sql}', {'search': params.get('search')})
+    estimate = int(cur.fetchone()['QUERY PLAN'][0]['Plan']['Plan Rows'])
+
+    has_prev = more if backwards else anchor is not None
+    has_next = more if not backwards else True
+    return {'rows': rows, 'columns': columns, 'estimate': estimate,
+            'prev_key': encode_page_key(page_keys[0]) if has_prev and rows else None,
+            'next_key': encode_page_key(page_keys[-1]) if has_next and rows else None}
+
+# --- ייצוא בזרימה ---
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_QUEUE_CHUNKS = 16  # לכל היותר ~1MB ממתין בזיכרון בין COPY לבין הלקוח
+EXPORT_XLSX_ITERSIZE = 5000
+XLSX_MAX_ROWS = 1048576  # מגבלת שורות לגיליון ב-Excel (כולל כותרת)
+# קובץ Excel נבנה כולו לפני הבייט הראשון (זמן ודיסק לפי הגודל). מעל המגבלה מפנים לייצוא CSV דחוס, שזורם מיד. 0 = בלי מגבלה
+EXPORT_XLSX_MAX_ROWS = int(os.getenv("EXPORT_XLSX_MAX_ROWS", "200000"))
+
+class ExportCancelled(Exception):
+    pass
+
+class ChunkQueueWriter:
+    """היעד של copy_expert: אוסף את השורות ל-chunks ומעביר אותם לתור חסום (הלקוח האיטי מאט את COPY)."""
+
+    def __init__(self, chunks, cancelled):
+        self.chunks, self.cancelled = chunks, cancelled
+        self.buf, self.size = [], 0
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set(): raise ExportCancelled()
+            try:
+                self.chunks.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= EXPORT_CHUNK_BYTES: self.flush()
+
+    def flush(self):
+        if self.buf: self.put(b''.join(self.buf))
+        self.buf, self.size = [], 0
+
+def stream_copy(copy_sql):
+    """מריץ COPY ... TO STDOUT ב-thread על חיבור מה-pool ומחזיר generator של chunks. זיכרון קבוע, בייט ראשון מהיר."""
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    writer = ChunkQueueWriter(chunks, cancelled)
+
+    def produce():
+        try:
+            with db_connection() as conn:
+                with conn.cursor() as cur: cur.copy_expert(copy_sql, writer)
+            writer.flush()
+            writer.put(None)
+        except ExportCancelled:
+            pass
+        except Exception as e:
+            try: writer.put(e)
+            except ExportCancelled: pass
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None: return
+            if isinstance(item, Exception): raise item
+            yield item
+    finally:
+        # הלקוח התנתק או שהסתיים: עוצרים את ה-COPY ומחכים שהחיבור יחזור ל-pool
+        cancelled.set()
+        producer.join()
+
+def gzip_stream(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = פורמט gzip
+    try:
+        for chunk in chunks:
+            out = z.compress(chunk)
+            if out: yield out
+        yield z.flush()
+    finally:
+        chunks.close()
+
+def xlsx_too_large(view_name):
+    # ספירה עד המגבלה בלבד (LIMIT), כך שגם view ענק לא נספר עד הסוף
+    if not EXPORT_XLSX_MAX_ROWS: return False
+    with db_cursor(None) as cur:
+        cur.execute(f'SELECT count(*) FROM (SELECT 1 FROM "{view_name}" LIMIT %s) x', (EXPORT_XLSX_MAX_ROWS + 1,))
+        return cur.fetchone()[0] > EXPORT_XLSX_MAX_ROWS
+
+def export_xlsx_file(view_name):
+    # openpyxl במצב write-only כותב את הגיליון לקובץ זמני, והשורות נקראות ב-named cursor במנות.
+    # מעבר למגבלת השורות של Excel ממשיכים בגיליון נוסף עם אותה כותרת.
+    wb = Workbook(write_only=True)
+    with db_connection() as conn:
+        conn.autocommit = False  # named cursor חי בתוך טרנזקציה
+        with conn.cursor(name='export_xlsx') as cur:
+            cur.itersize = EXPORT_XLSX_ITERSIZE
+            cur.execute(f'SELECT * FROM "{view_name}" ORDER BY {report_order_by(view_name)}')
+            rows = iter(cur)
+            first = next(rows, None)
+            header = [d.name for d in cur.description]
+            for sheet_no in itertools.count(1):
+                ws = wb.create_sheet(view_name[:27] if sheet_no == 1 else f"{view_name[:27]} ({sheet_no})")
+                ws.append(header)
+                if first is not None: ws.append(first)
+                for row in itertools.islice(rows, XLSX_MAX_ROWS - 2):
+                    ws.append(row)
+                first = next(rows, None)
+                if first is None: break
+    out = tempfile.TemporaryFile()
+    wb.save(out)
+    out.seek(0)
+    return out
+
+@app.errorhandler(PoolTimeout)
+@app.errorhandler(DatabaseUnavailable)
+def db_unavailable(e):
+    app.logger.exception(f"DB unavailable: {e}")
+    return "DB Error", 503
+
+@app.route('/pool_stats')
+def pool_stats():
+    return jsonify(db_pool.stats())
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_start = time.perf_counter()
+    metrics_local.stats = QueryStats(request.endpoint or 'unknown')
+
+@app.after_request
+def record_request_metrics(response):
+    stats = getattr(metrics_local, 'stats', None)
+    if stats is None or 'metrics_start' not in g: return response
+    # בתשובה בזרימה (ייצוא) נמדד הזמן עד שהתשובה מתחילה לצאת
+    elapsed = time.perf_counter() - g.metrics_start
+    HTTP_REQUESTS.inc((stats.context, request.method, response.status_code))
+    HTTP_DURATION.observe((stats.context, request.method), elapsed)
+    REQUEST_QUERIES.observe((stats.context,), stats.count)
+    if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+        worst = ''.join(f"\n    {ms * 1000:8.1f} ms  {text}" for ms, _, text in sorted(stats.slowest, reverse=True))
+        app.logger.warning(f"slow request: {request.method} {request.full_path.rstrip('?')} ({stats.context}) {elapsed:.3f}s, "
+                           f"{stats.count} queries in {stats.seconds:.3f}s{worst}")
+    return response
+
+@app.teardown_request
+def clear_request_metrics(exc):
+    metrics_local.stats = None
+
+@app.route('/metrics')
+def metrics():
+    pool = db_pool.stats()
+    lines = [
+        "# HELP mishloach_db_pool_connections Pool connections by state.\n# TYPE mishloach_db_pool_connections gauge\n",
+        f'mishloach_db_pool_connections{{state="in_use"}} {pool["in_use"]}\n',
+        f'mishloach_db_pool_connections{{state="idle"}} {pool["idle"]}\n',
+        f"# HELP mishloach_db_pool_max Pool size limit.\n# TYPE mishloach_db_pool_max gauge\nmishloach_db_pool_max {pool['max']}\n",
+    ]
+    for key in ('checkouts', 'timeouts', 'reconnects', 'discarded'):
+        lines.append(f"# HELP mishloach_db_pool_{key}_total Pool {key}.\n# TYPE mishloach_db_pool_{key}_total counter\n"
+                     f"mishloach_db_pool_{key}_total {pool[key]}\n")
+    lines.append("# HELP mishloach_db_pool_wait_seconds_total Time spent waiting for a pool connection.\n"
+                 f"# TYPE mishloach_db_pool_wait_seconds_total counter\nmishloach_db_pool_wait_seconds_total {pool['wait_total']}\n")
+    for m in METRICS: lines.extend(m.render())
+    return Response(''.join(lines), mimetype='text/plain; version=0.0.4')
+
+# --- לוח הבקרה: מונים במטמון ---
+# המטמון בזיכרון של התהליך. עבודות רקע, איפוס ו-autoreturn מנקים אותו מיד; כתיבה מתהליך אחר
+# (CLI, worker נוסף של gunicorn) נראית לכל היותר אחרי DASHBOARD_CACHE_SECONDS
+DASHBOARD_CACHE_SECONDS = float(os.getenv("DASHBOARD_CACHE_SECONDS", "10"))
+DASHBOARD_ESTIMATE_ROWS = int(os.getenv("DASHBOARD_ESTIMATE_ROWS", "0"))  # 0 = תמיד COUNT מדויק
+
+class StatsCache:
+    """ערך אחד שמחושב מחדש אחרי ttl שניות או אחרי invalidate()."""
+    def __init__(self, ttl, compute):
+        self.ttl, self.compute = ttl, compute
+        self._lock = threading.Lock()
+        self._value, self._at, self._generation = None, 0.0, 0
+
+    def get(self):
+        with self._lock:
+            if self._value is not None and time.monotonic() - self._at < self.ttl: return self._value
+            generation = self._generation
+        value = self.compute()
+        with self._lock:
+            # חישוב שהתחיל לפני invalidate() לא נשמר - הוא עלול לא לכלול את הכתיבה האחרונה
+            if generation == self._generation: self._value, self._at = value, time.monotonic()
+        return value
+
+    def invalidate(self):
+        with self._lock: self._value, self._generation = None, self._generation + 1
+
+def table_count(cur, table):
+    """מחזיר (מספר שורות, האם הערכה). מעל DASHBOARD_ESTIMATE_ROWS - הערכה מ-pg_class במקום COUNT(*):
+    צפיפות השורות מה-ANALYZE האחרון כפול מספר הדפים הנוכחי, כמו שהמתכנן מעריך."""
+    if DASHBOARD_ESTIMATE_ROWS:
+        cur.execute("""
+            SELECT (reltuples / relpages * (pg_relation_size(oid) / current_setting('block_size')::int))::bigint AS estimate
+            FROM pg_class WHERE oid = %s::regclass AND reltuples >= 0 AND relpages > 0
+        """, (table,))
+        row = cur.fetchone()
+        if row and row['estimate'] >= DASHBOARD_ESTIMATE_ROWS: return row['estimate'], True
+    cur.execute(f"SELECT COUNT(*) AS count FROM {table}")
+    return cur.fetchone()['count'], False
+
+def compute_dashboard_stats():
+    with db_cursor() as cur:
+        families, families_estimated = table_count(cur, 'person')
+        orders, orders_estimated = table_count(cur, '"Order"')
+        # אינדקס חלקי (מיגרציה 0009): סופר רק את ההזמנות הממתינות, לא את כל הטבלה
+        cur.execute("SELECT COUNT(*) AS count FROM outerapporder WHERE status = 'waiting'")
+        pending = cur.fetchone()['count']
+    estimated = [name for name, est in (('families', families_estimated), ('orders', orders_estimated)) if est]
+    return {'families': families, 'orders': orders, 'pending': pending, 'estimated': estimated, 'as_of': time.time()}
+
+dashboard_stats = StatsCache(DASHBOARD_CACHE_SECONDS, compute_dashboard_stats)
+
+def invalidate_dashboard_stats():
+    dashboard_stats.invalidate()
 
 @app.route('/')
 def index():
-    conn = get_db_connection()
-    if not conn: return "DB Error", 500
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    auto_fix_database(cur)
-    cur.execute("SELECT COUNT(*) as count FROM person")
-    f = cur.fetchone()['count']
-    cur.execute('SELECT COUNT(*) as count FROM "Order"')
-    o = cur.fetchone()['count']
-    cur.execute("SELECT COUNT(*) as count FROM outerapporder WHERE status='waiting'")
-    p = cur.fetchone()['count']
-    cur.close(); conn.close()
-    return render_template('index.html', families=f, orders=o, pending=p)
+    return render_template('index.html', stats=dashboard_stats.get(), poll_seconds=max(DASHBOARD_CACHE_SECONDS, 5))
+
+@app.route('/stats')
+def stats():
+    return jsonify(dashboard_stats.get())
 
 @app.route('/reset_db', methods=['POST'])
 def reset_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute('TRUNCATE TABLE "payment_ledger", "Order", "outerapporder", "person_archive", "raw_residents_csv", "temp_residents_csv" CASCADE;')
-        cur.execute('DELETE FROM "person";')
-        cur.execute("ALTER SEQUENCE public.person_personid_seq RESTART WITH 100000;") # איפוס חכם
-        cur.execute("ALTER SEQUENCE public.order_id_seq RESTART WITH 1;")
-        cur.execute("INSERT INTO public.street (streetcode, streetname) VALUES (999, 'רחוב כללי') ON CONFLICT (streetcode) DO NOTHING;")
-        flash('המערכת אופסה בהצלחה!', 'success')
-    except Exception as e: flash(f'שגיאה: {e}', 'danger')
-    conn.close()
+    with db_cursor(None) as cur:
+        try:
+            cur.execute('TRUNCATE TABLE "payment_ledger", "Order", "outerapporder", "person_archive", "raw_residents_csv", "temp_residents_csv" CASCADE;')
+            cur.execute('DELETE FROM "person";')
+            cur.execute("ALTER SEQUENCE public.person_personid_seq RESTART WITH 100000;") # איפוס חכם
+            cur.execute("ALTER SEQUENCE public.order_id_seq RESTART WITH 1;")
+            cur.execute("INSERT INTO public.street (streetcode, streetname) VALUES (999, 'רחוב כללי') ON CONFLICT (streetcode) DO NOTHING;")
+            invalidate_dashboard_stats()
+            flash('המערכת אופסה בהצלחה!', 'success')
+        except Exception as e: flash(f'שגיאה: {e}', 'danger')
     return redirect(url_for('index'))
 
 @app.route('/residents', methods=['GET', 'POST'])
 def residents():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    auto_fix_database(cur)
     if request.method == 'POST':
         file = request.files['file']
+        job_id = None
         if file:
-            try:
-                df = None
-                fname = file.filename.lower()
-                if fname.endswith('.xlsx'):
-                    try: df = pd.read_excel(file, engine='openpyxl', header=None)
-                    except: pass
-                if df is None:
-                    for enc in ['utf-8-sig', 'cp1255', 'utf-8', 'windows-1252', 'iso-8859-8']:
-                        try:
-                            file.seek(0)
-                            df = pd.read_csv(file, encoding=enc, header=None, sep=None, engine='python')
-                            if df.shape[1] > 1: break
-                        except: continue
-                
-                if df is None: flash('לא ניתן לקרוא את הקובץ', 'danger')
-                else:
-                    # זיהוי כותרת
-                    header_idx = -1
-                    for i, row in df.head(30).iterrows():
-                        txt = " ".join([str(v) for v in row.values]).lower()
-                        if 'lastname' in txt or 'משפחה' in txt or 'code' in txt or 'קוד' in txt:
-                            header_idx = i
-                            break
-                    if header_idx > -1:
-                        df.columns = df.iloc[header_idx]
-                        df = df[header_idx + 1:].reset_index(drop=True)
-                    else:
-                        df.columns = df.iloc[0]
-                        df = df[1:].reset_index(drop=True)
-                    
-                    clean, diag_msg = extract_clean_data(df)
-                    
-                    cur.execute("TRUNCATE TABLE raw_residents_csv RESTART IDENTITY")
-                    vals = []
-                    sample_codes = []
-                    for r in clean:
-                        if r['code']: 
-                            if len(sample_codes) < 5: sample_codes.append(str(r['code']))
-                        vals.append((r['code'], r['lastname'], r['father_name'], r['mother_name'], r['streetname'], r['buildingnumber'], r['entrance'], r['apartmentnumber'], r['phone'], r['mobile'], r['mobile2'], r['email'], r['standing_order']))
-                    
-                    q = "INSERT INTO raw_residents_csv (code, lastname, father_name, mother_name, streetname, buildingnumber, entrance, apartmentnumber, phone, mobile, mobile2, email, standing_order) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-                    execute_batch(cur, q, vals)
-                    
-                    cur.execute("SELECT raw_to_temp_stage()")
-                    cur.execute("SELECT process_residents_csv()")
-                    
-                    # בדיקת מקסימום
-                    cur.execute("SELECT MAX(personid) as m FROM person")
-                    mx = cur.fetchone()['m']
-                    
-                    flash(f'קובץ נקלט! {len(vals)} רשומות. {diag_msg}. (ID מקסימלי: {mx}, דוגמאות: {", ".join(sample_codes)})', 'success')
-            except Exception as e: flash(f'שגיאה: {e}', 'danger')
-    
-    cur.execute("SELECT * FROM missing_streets_log ORDER BY id DESC LIMIT 10")
-    missing = cur.fetchall()
-    cur.execute("SELECT * FROM person_archive ORDER BY created_at DESC LIMIT 20")
-    log = cur.fetchall()
-    cur.close(); conn.close()
-    return render_template('residents.html', missing_streets=missing, archive_log=log)
+            path = save_upload(file)
+            job_id = submit_job('residents', import_residents_job, path, file.filename, upload=path)
+            flash(f'הקליטה התחילה ברקע (עבודה #{job_id}).', 'info')
+        return job_redirect('residents', job_id)
+
+    with db_cursor() as cur:
+        # לכל רחוב חדש: הרחוב הקיים הכי דומה (pg_trgm), כהצעה למיפוי אם זו טעות כתיב
+        cur.execute("""
+            SELECT m.*, sug.streetcode AS suggested_code, sug.streetname AS suggested_name
+            FROM (SELECT * FROM missing_streets_log ORDER BY id DESC LIMIT 10) m
+            LEFT JOIN LATERAL (
+                SELECT s.streetcode, s.streetname FROM street s
+                WHERE s.streetname % m.streetname AND s.street_key IS DISTINCT FROM street_key(m.streetname)
+                ORDER BY similarity(s.streetname, m.streetname) DESC LIMIT 1) sug ON true
+            ORDER BY m.id DESC
+        """)
+        missing = cur.fetchall()
+        # רחובות כפולים מלפני street_key (מיגרציה 0010): כל כפול בלי מפתח מול הרחוב שקיבל את המפתח
+        cur.execute("""
+            SELECT d.streetcode, d.streetname, d.residents, k.streetcode AS keeper_code, k.streetname AS keeper_name
+            FROM v_street_key_conflicts d JOIN v_street_key_conflicts k ON k.street_key = d.street_key AND k.active
+            WHERE NOT d.active ORDER BY d.street_key, d.streetcode
+        """)
+        conflicts = cur.fetchall()
+        cur.execute("SELECT * FROM person_archive ORDER BY created_at DESC LIMIT 20")
+        log = cur.fetchall()
+    return render_template('residents.html', missing_streets=missing, street_conflicts=conflicts, archive_log=log,
+                           jobs=recent_jobs(['residents']))
+
+@app.route('/streets/alias', methods=['POST'])
+def street_alias():
+    alias = request.form.get('alias', '').strip()
+    try:
+        with db_cursor() as cur:
+            cur.execute("SELECT add_street_alias(%s, %s) AS moved", (alias, int(request.form.get('streetcode'))))
+            moved = cur.fetchone()['moved']
+        flash(f'"{alias}" ימופה מעכשיו לרחוב הקיים ({moved} תושבים הועברו).', 'success')
+    except (TypeError, ValueError): flash('קוד רחוב לא תקין', 'danger')
+    except psycopg2.Error as e: flash(f'שגיאה: {e.diag.message_primary or e}', 'danger')
+    return redirect(url_for('residents'))
 
 @app.route('/orders', methods=['GET', 'POST'])
 def orders():
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
     if request.method == 'POST':
         action = request.form.get('action')
+        job_id = None
         if action == 'upload':
             file = request.files['file']
             if file:
-                try:
-                    df = None
-                    if file.filename.lower().endswith('.csv'):
-                        try: file.seek(0); df = pd.read_csv(file, encoding='utf-8-sig')
-                        except: file.seek(0); df = pd.read_csv(file, encoding='cp1255')
-                    else: file.seek(0); df = pd.read_excel(file, engine='openpyxl')
-                    
-                    clean, _ = extract_clean_data(df)
-                    # שחזור הזמנות
-                    df.columns = [str(c).strip().lower() for c in df.columns]
-                    col_sender = next((c for c in df.columns if 'sender' in c or 'order_code' in c or 'code' in c or 'קוד' in c), None)
-                    col_invitees = next((c for c in df.columns if 'invite' in c or 'guest' in c or 'מוזמנים' in c), None)
-                    col_phone = next((c for c in df.columns if 'phone' in c or 'mobile' in c or 'טלפון' in c), None)
-                    
-                    vals = []
-                    for _, row in df.iterrows():
-                        s = clean_int_str(row[col_sender]) if col_sender else ''
-                        i = str(handle_series(row[col_invitees])) if col_invitees else ''
-                        p = str(handle_series(row[col_phone])) if col_phone else None
-                        if s or i: vals.append((s, i, 'סמלי', 'upload', p))
-                    
-                    q = "INSERT INTO outerapporder (sender_code, invitees, package_size, origin, sender_phone) VALUES (%s, %s, %s, %s, %s)"
-                    execute_batch(cur, q, vals)
-                    flash(f'נטענו {len(vals)} הזמנות.', 'info')
-                except Exception as e: flash(f'שגיאה: {e}', 'danger')
+                path = save_upload(file)
+                job_id = submit_job('orders_upload', load_outer_orders_job, path, file.filename, upload=path)
+                flash(f'הטעינה התחילה ברקע (עבודה #{job_id}).', 'info')
         elif action == 'distribute':
-            cnt, msgs = distribute_in_python()
-            for m in msgs: flash(m, 'success' if cnt > 0 else 'danger')
+            running = active_job('distribute')
+            if running: flash(f'הפצה כבר רצה (עבודה #{running}).', 'warning')
+            else:
+                job_id = submit_job('distribute', distribute_job)
+                flash(f'ההפצה התחילה ברקע (עבודה #{job_id}).', 'info')
+        return job_redirect('orders', job_id)
 
-    cur.execute("SELECT * FROM v_outer_distribution_status LIMIT 50")
-    rows = cur.fetchall()
-    cur.execute("SELECT * FROM outerapporder_error_log ORDER BY id DESC LIMIT 20")
-    errs = cur.fetchall()
-    cur.close(); conn.close()
-    return render_template('orders.html', status_rows=rows, errors=errs)
+    with db_cursor() as cur:
+        cur.execute("SELECT * FROM v_outer_distribution_status ORDER BY id DESC LIMIT 50")
+        rows = cur.fetchall()
+        cur.execute("SELECT * FROM outerapporder_error_log ORDER BY id DESC LIMIT 20")
+        errs = cur.fetchall()
+    return render_template('orders.html', status_rows=rows, errors=errs, jobs=recent_jobs(['orders_upload', 'distribute']))
+
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None: abort(404)
+    return jsonify(job)
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    if get_job(job_id) is None: abort(404)
+    cancel_job(job_id)
+    return jsonify(get_job(job_id))
 
 @app.route('/report/<view_name>')
 def report(view_name):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
+    if view_name not in REPORT_VIEWS: abort(404)
     search = request.args.get('search', '')
-    q = f'SELECT * FROM "{view_name}"'
-    p = {}
-    if search:
-        if view_name == 'v_accounts_summary': q += " WHERE sender_name LIKE %(search)s"
-        elif view_name == 'v_families_balance': q += " WHERE lastname LIKE %(search)s"
-        elif view_name == 'v_orders_details': q += " WHERE sender_name LIKE %(search)s OR getter_name LIKE %(search)s"
-        elif view_name == 'v_packages_per_building': q += " WHERE streetname LIKE %(search)s"
-        p['search'] = f'%{search}%'
-    else: q += " LIMIT 100"
-    try: cur.execute(q, p); rows = cur.fetchall(); cols = rows[0].keys() if rows else []
-    except: rows, cols = [], []
-    cur.close(); conn.close()
-    return render_template('report.html', view_name=view_name, rows=rows, columns=cols)
+    after = decode_page_key(request.args['after'], view_name) if request.args.get('after') else None
+    before = decode_page_key(request.args['before'], view_name) if request.args.get('before') and after is None else None
+    with db_cursor() as cur:
+        try: page = report_page(cur, view_name, search, after, before)
+        except psycopg2.Error as e:
+            flash(f'שגיאה: {e}', 'danger')
+            page = {'rows': [], 'columns': [], 'estimate': 0, 'prev_key': None, 'next_key': None}
+    return render_template('report.html', view_name=view_name, search=search, **page)
 
 @app.route('/export/<view_name>')
 def export_csv(view_name):
-    conn = get_db_connection()
-    df = pd.read_sql_query(f'SELECT * FROM "{view_name}"', conn)
-    conn.close()
-    return Response(df.to_csv(index=False), mimetype="text/csv", headers={"Content-disposition": f"attachment; filename={view_name}.csv"})
+    if view_name not in REPORT_VIEWS: abort(404)
+    if request.args.get('format') == 'xlsx':
+        if xlsx_too_large(view_name):
+            flash(f'הדוח גדול מ-{EXPORT_XLSX_MAX_ROWS:,} שורות ולכן יוצא כ-CSV דחוס (נפתח באקסל אחרי חילוץ).', 'warning')
+            return redirect(url_for('export_csv', view_name=view_name, gzip=1))
+        return send_file(export_xlsx_file(view_name), as_attachment=True, download_name=f"{view_name}.xlsx",
+                         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    body = stream_copy(f'COPY (SELECT * FROM "{view_name}" ORDER BY {report_order_by(view_name)}) TO STDOUT WITH (FORMAT csv, HEADER)')
+    if request.args.get('gzip') == '1':
+        return Response(gzip_stream(body), mimetype="application/gzip", headers={"Content-disposition": f"attachment; filename={view_name}.csv.gz"})
+    return Response(body, mimetype="text/csv", headers={"Content-disposition": f"attachment; filename={view_name}.csv"})
 
 @app.route('/apply_autoreturn', methods=['POST'])
 def apply_autoreturn():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.callproc('apply_autoreturn_for', [int(request.form.get('family_id'))])
-    conn.close()
+    families, orders = run_autoreturn(family_id=int(request.form.get('family_id')))
+    flash(autoreturn_message(families, orders, False), 'success' if orders else 'info')
+    return redirect(url_for('report', view_name='v_families_balance'))
+
+@app.route('/apply_autoreturn_all', methods=['POST'])
+def apply_autoreturn_all():
+    dry_run = request.form.get('dry_run') == '1'
+    try:
+        families, orders = run_autoreturn(dry_run=dry_run)
+        flash(autoreturn_message(families, orders, dry_run), 'success' if orders and not dry_run else 'info')
+    except psycopg2.Error as e: flash(f'שגיאה: {e}', 'danger')
     return redirect(url_for('report', view_name='v_families_balance'))
 
 if __name__ == '__main__':
+    if MIGRATE_ON_STARTUP: migrate()
+    fail_interrupted_jobs()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""בדיקת בטיחות משותפת לסקריפטי המדידה: כולם מוחקים, מאפסים או כותבים נתונים במסד של DATABASE_URL.
+
+כל סקריפט קורא ל-require_bench_db() לפני שהוא נוגע במסד, ונעצר אם שם המסד לא מכיל bench או test.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app  # noqa: E402
+
+
+def require_bench_db():
+    conn = app.get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT current_database()")
+        db = cur.fetchone()[0]
+    finally:
+        conn.close()
+    if 'bench' not in db and 'test' not in db:
+        sys.exit(f"המסד {db} לא נראה כמו מסד בדיקות (bench/test) - הסקריפט מוחק ומשנה נתונים")
+    return db
+
+
+# process_residents_csv לפני user-003 (לולאה לכל שורה), להשוואה מול הגרסה המבוססת על קבוצות.
+# נוצרת ב-pg_temp כדי לא להשאיר אותה במסד; קוראים לה pg_temp.process_residents_csv_legacy()
+LEGACY_PROCESS_RESIDENTS_SQL = """
+CREATE OR REPLACE FUNCTION pg_temp.process_residents_csv_legacy() RETURNS void LANGUAGE plpgsql AS $func$
+DECLARE
+    rec RECORD; existing_person INT; target_id INT;
+BEGIN
+    PERFORM setval('public.person_personid_seq', GREATEST((SELECT COALESCE(MAX(personid), 0) + 1 FROM public.person), 100000), false);
+
+    FOR rec IN SELECT * FROM temp_residents_csv ORDER BY temp_id LOOP
+        target_id := rec.code; existing_person := NULL;
+        IF target_id IS NOT NULL THEN SELECT personid INTO existing_person FROM person WHERE personid = target_id; END IF;
+        IF existing_person IS NULL THEN SELECT personid INTO existing_person FROM person WHERE format_il_phone(phone) = format_il_phone(rec.phone) LIMIT 1; END IF;
+        IF existing_person IS NOT NULL THEN
+            UPDATE person SET lastname = COALESCE(rec.lastname, lastname), email = COALESCE(rec.email, email), standing_order = COALESCE(rec.standing_order, standing_order), streetcode = COALESCE(rec.streetcode, streetcode) WHERE personid = existing_person;
+            UPDATE temp_residents_csv SET status = 'עודכן' WHERE temp_id = rec.temp_id;
+        ELSE
+            IF target_id IS NOT NULL THEN
+                INSERT INTO person(personid, lastname, father_name, mother_name, streetcode, buildingnumber, entrance, apartmentnumber, phone, mobile, mobile2, email, standing_order) VALUES (target_id, rec.lastname, rec.father_name, rec.mother_name, rec.streetcode, rec.buildingnumber, rec.entrance, rec.apartmentnumber, rec.phone, rec.mobile, rec.mobile2, rec.email, rec.standing_order) ON CONFLICT (personid) DO UPDATE SET lastname = EXCLUDED.lastname;
+            ELSE
+                INSERT INTO person(lastname, father_name, mother_name, streetcode, buildingnumber, entrance, apartmentnumber, phone, mobile, mobile2, email, standing_order) VALUES (rec.lastname, rec.father_name, rec.mother_name, rec.streetcode, rec.buildingnumber, rec.entrance, rec.apartmentnumber, rec.phone, rec.mobile, rec.mobile2, rec.email, rec.standing_order);
+            END IF;
+            UPDATE temp_residents_csv SET status = 'נוסף' WHERE temp_id = rec.temp_id;
+        END IF;
+    END LOOP;
+END;
+$func$;
+"""
+
+PERSON_COLUMNS = ('personid, lastname, father_name, mother_name, streetcode, buildingnumber, entrance, apartmentnumber, '
+                  'phone, mobile, mobile2, email, standing_order')
+
+
+def merge_snapshot(cur, function):
+    """מריץ את פונקציית המיזוג בתוך טרנזקציה שמתגלגלת אחורה, ומחזיר (תושבים, סטטוסים) אחרי ההרצה.
+
+    person ו-temp_residents_csv חוזרים למצבם הקודם, כך שאפשר להריץ את שתי הגרסאות על אותו קלט.
+    """
+    cur.execute("BEGIN")
+    try:
+        cur.execute(f"SELECT {function}()")
+        cur.execute(f"SELECT {PERSON_COLUMNS} FROM person ORDER BY personid")
+        people = cur.fetchall()
+        cur.execute("SELECT temp_id, status FROM temp_residents_csv ORDER BY temp_id")
+        statuses = cur.fetchall()
+    finally:
+        cur.execute("ROLLBACK")
+    return people, statuses
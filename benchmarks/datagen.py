@@ -0,0 +1,118 @@
+"""מחולל נתונים סינתטיים לבדיקות ביצועים: קובץ תושבים וקובץ הזמנות מהאפליקציה, כמו שמגיעים בפועל.
+
+אותו seed = אותם קבצים בדיוק. בקובץ התושבים יש שמות ורחובות בעברית, טלפונים בפורמטים שונים (02-, +972, רווחים,
+סוגריים), קודים כפולים, קודים בפורמט אקסל ("12.0"), שורות בלי קוד ורחובות שלא קיימים בטבלת street.
+בקובץ ההזמנות יש מוזמנים מופרדים ב-| או בפסיקים, שולחים לפי טלפון בלבד וקודים שלא קיימים.
+הרצה:
+    python benchmarks/datagen.py 10000 /tmp/data --seed 1
+"""
+import os
+import csv
+import sys
+import random
+import argparse
+
+LASTNAMES = ['כהן', 'לוי', 'מזרחי', 'פרץ', 'ביטון', 'דהן', 'אברהם', 'פרידמן', 'אזולאי', 'כץ', 'יוסף', 'דוד',
+             'עמר', 'אוחיון', 'חדד', 'גבאי', 'בן דוד', 'שפירא', 'רוזנברג', 'גולדשטיין', 'ויס', 'קליין', 'הורוביץ',
+             'אלון', 'שטרן', 'ברגר', 'רבינוביץ', 'טל', 'שלום', 'נחום', 'סויסה', 'אשכנזי', 'ליברמן', 'גרינברג']
+MALE_NAMES = ['משה', 'דוד', 'יוסף', 'אברהם', 'יעקב', 'יצחק', 'שמואל', 'אליהו', 'חיים', 'מנחם', 'אהרן', 'ישראל',
+              'מרדכי', 'שלמה', 'בנימין', 'נחום', 'צבי', 'אריה']
+FEMALE_NAMES = ['שרה', 'רבקה', 'רחל', 'לאה', 'מרים', 'אסתר', 'חנה', 'יעל', 'דבורה', 'נעמי', 'רות', 'תמר',
+                'שושנה', 'מלכה', 'פנינה', 'אילנה', 'חיה', 'ציפורה']
+STREETS = ['הרצל', 'יפו', 'בן יהודה', 'הנביאים', 'שטראוס', 'מלכי ישראל', 'בר אילן', 'סורוצקין', 'פנים מאירות',
+           'חזון איש', 'רבי עקיבא', 'ז\'בוטינסקי', 'נחל שורק', 'נחל לכיש', 'נחל רפאים', 'הרב קוק', 'עזרא',
+           'דוד ילין', 'שמואל הנביא', 'אבן גבירול', 'בית הדפוס', 'קצנלנבוגן', 'גבעת שאול', 'הפסגה', 'מעגלי הרי"ם לוין',
+           'שדרות גולדה מאיר', 'החיד"א', 'ירמיהו', 'יחזקאל', 'תחכמוני']
+RESIDENT_HEADER = ['קוד', 'שם משפחה', 'שם אבא', 'שם אמא', 'רחוב', 'מספר בית', 'כניסה', 'דירה', 'טלפון', 'נייד',
+                   'נייד 2', 'מייל', 'הוראת קבע']
+ORDER_HEADER = ['קוד שולח', 'מוזמנים', 'טלפון']
+
+
+def mobile_of(code):
+    # הנייד של תושב נגזר מהקוד, כך שקובץ ההזמנות יכול לזהות שולח לפי טלפון בלי לזכור את קובץ התושבים
+    return f'05{code % 10}{code % 10000000:07d}'
+
+
+def messy_phone(rng, number):
+    """אותו מספר (0XXXXXXXXX) בפורמט אקראי מהפורמטים שמופיעים בקבצים אמיתיים."""
+    prefix, rest = (number[:3], number[3:]) if number.startswith('05') else (number[:2], number[2:])
+    return rng.choice([
+        f'{prefix}-{rest}', number, f'+972-{prefix[1:]}-{rest}', f'972{number[1:]}', f'({prefix}) {rest}',
+        f'{prefix} {rest[:3]} {rest[3:]}', f' {prefix}-{rest} ', f'{prefix}.{rest}',
+    ])
+
+
+def street_name(rng, streets):
+    name = rng.choice(streets)
+    roll = rng.random()
+    # כ-3% כתובים אחרת ממה שבטבלת street, כמו בקבצים מהשטח: קידומת (רחוב חדש למיפוי) או רווחים (אותו רחוב)
+    if roll < 0.01: return f"רח' {name}"
+    if roll < 0.02: return f'רחוב {name}'
+    if roll < 0.03: return f' {name}  '
+    return name
+
+
+def write_residents(path, n, seed=1, streets=STREETS):
+    """n שורות תושבים. מחזיר את הקודים שנכתבו (עם כפילויות), לבחירת שולחים ומוזמנים."""
+    rng = random.Random(seed)
+    codes = []
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(RESIDENT_HEADER)
+        for i in range(1, n + 1):
+            roll = rng.random()
+            if roll < 0.01 and i > 1: code = str(rng.randint(1, i - 1))  # קוד כפול
+            elif roll < 0.02: code = f'{i}.0'  # ייצוא מאקסל
+            elif roll < 0.025: code = ''  # בלי קוד - מקבל מזהה אוטומטי
+            else: code = str(i)
+            if code: codes.append(int(float(code)))
+            home = f'02{rng.randint(5000000, 6999999)}' if rng.random() < 0.7 else ''
+            mobile = mobile_of(i)
+            row = [
+                code, rng.choice(LASTNAMES),
+                rng.choice(MALE_NAMES) if rng.random() < 0.97 else '',
+                rng.choice(FEMALE_NAMES) if rng.random() < 0.9 else '',
+                street_name(rng, streets), str(rng.randint(1, 120)), rng.choice(['', '', 'א', 'ב', 'ג']),
+                str(rng.randint(1, 40)) if rng.random() < 0.9 else '',
+                messy_phone(rng, home) if home else '', messy_phone(rng, mobile),
+                messy_phone(rng, mobile_of(i + n)) if rng.random() < 0.2 else '',
+                f'family{i}@example.com' if rng.random() < 0.5 else '', str(rng.choice([0, 0, 0, 1])),
+            ]
+            out.writerow(row)
+    return codes
+
+
+def write_orders(path, n, codes, seed=1, max_invitees=6):
+    """n הזמנות מהאפליקציה לתושבים עם הקודים codes: 95% לפי קוד, 3% לפי טלפון בלבד, 2% קוד לא קיים."""
+    rng = random.Random(seed + 1)
+    unknown = max(codes) + 1
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(ORDER_HEADER)
+        for _ in range(n):
+            sender = rng.choice(codes)
+            roll = rng.random()
+            if roll < 0.03: sender_code, phone = '', messy_phone(rng, mobile_of(sender))
+            elif roll < 0.05: sender_code, phone = str(unknown + rng.randint(0, 1000)), ''
+            else: sender_code, phone = str(sender), ''
+            invitees = [str(rng.choice(codes)) for _ in range(rng.randint(1, max_invitees))]
+            if rng.random() < 0.02: invitees.append(str(unknown + rng.randint(0, 1000)))
+            sep = rng.choice(['|', '|', ', ', ','])
+            out.writerow([sender_code, sep.join(invitees), phone])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='קבצי תושבים והזמנות סינתטיים')
+    parser.add_argument('residents', type=int)
+    parser.add_argument('out_dir')
+    parser.add_argument('--orders', type=int, help='מספר הזמנות (ברירת מחדל: כמו מספר התושבים)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+    codes = write_residents(os.path.join(args.out_dir, 'residents.csv'), args.residents, args.seed)
+    write_orders(os.path.join(args.out_dir, 'orders.csv'), args.orders or args.residents, codes, args.seed)
+    print(f"{args.residents:,} residents, {args.orders or args.residents:,} orders -> {args.out_dir}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
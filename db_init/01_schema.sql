@@ -190,7 +190,7 @@ ALTER FUNCTION "public"."distribute_all_outer_orders"() OWNER TO "postgres";
 
 
 CREATE OR REPLACE FUNCTION "public"."format_il_phone"("p_text" "text", "p_default_area" "text" DEFAULT '02'::"text") RETURNS "text"
-    LANGUAGE "plpgsql"
+    LANGUAGE "plpgsql" IMMUTABLE PARALLEL SAFE
     AS $$
 DECLARE
     e text := p_text;
@@ -0,0 +1,5 @@
+-- עמודות שנוספו אחרי הסכמה הראשונית, והרחוב הכללי (999) שתושבים בלי רחוב משויכים אליו
+DROP INDEX IF EXISTS public.ux_person_unique_phone_address;
+ALTER TABLE public.temp_residents_csv ADD COLUMN IF NOT EXISTS code integer;
+ALTER TABLE public.outerapporder ADD COLUMN IF NOT EXISTS sender_phone text;
+INSERT INTO public.street (streetcode, streetname) VALUES (999, 'רחוב כללי') ON CONFLICT (streetcode) DO NOTHING;
@@ -0,0 +1,22 @@
+-- טלפון מנורמל שמור + אינדקס, לחיפוש תושב לפי טלפון בלי לסרוק את כל person
+CREATE OR REPLACE FUNCTION "public"."format_il_phone"("p_text" "text", "p_default_area" "text" DEFAULT '02'::"text") RETURNS "text"
+LANGUAGE "plpgsql" IMMUTABLE PARALLEL SAFE AS $func$
+DECLARE
+    e text := p_text;
+BEGIN
+    IF e IS NULL OR btrim(e) = '' THEN RETURN NULL; END IF;
+    e := regexp_replace(e, '\D', '', 'g');
+    IF left(e,3) = '972' THEN e := '0' || substring(e FROM 4); END IF;
+    IF left(e,1) <> '0' THEN e := p_default_area || e; END IF;
+    e := regexp_replace(e, '^0+', '0');
+    IF length(e) = 7 THEN e := p_default_area || e; END IF;
+    IF length(e) BETWEEN 7 AND 10 THEN RETURN e; ELSE RETURN NULL; END IF;
+END;
+$func$;
+
+ALTER TABLE public.person ADD COLUMN IF NOT EXISTS phone_norm text GENERATED ALWAYS AS (public.format_il_phone(phone)) STORED;
+CREATE INDEX IF NOT EXISTS ix_person_phone_norm ON public.person (phone_norm);
+ALTER TABLE public.person ADD COLUMN IF NOT EXISTS mobile_norm text GENERATED ALWAYS AS (public.format_il_phone(mobile)) STORED;
+CREATE INDEX IF NOT EXISTS ix_person_mobile_norm ON public.person (mobile_norm);
+ALTER TABLE public.person ADD COLUMN IF NOT EXISTS mobile2_norm text GENERATED ALWAYS AS (public.format_il_phone(mobile2)) STORED;
+CREATE INDEX IF NOT EXISTS ix_person_mobile2_norm ON public.person (mobile2_norm);
@@ -0,0 +1,23 @@
+-- מפתח ייחודי להזמנה (שולח, מקבל, מקור) - בלעדיו ON CONFLICT DO NOTHING לא מונע כלום.
+-- כפילויות קיימות מאוחדות פעם אחת לפני יצירת האינדקס, והתשלומים מועברים להזמנה שנשארת.
+DO $do$
+BEGIN
+  IF to_regclass('public.ux_order_sender_getter_origin') IS NULL THEN
+    CREATE TEMP TABLE order_dups ON COMMIT DROP AS
+    SELECT id, keep_id FROM (
+      SELECT id, MIN(id) OVER (PARTITION BY delivery_sender_id, delivery_getter_id, origin_type, origin_outer_id) AS keep_id
+      FROM public."Order") d
+    WHERE id <> keep_id;
+    UPDATE public.payment_ledger pl SET order_id = d.keep_id FROM order_dups d WHERE pl.order_id = d.id;
+    DELETE FROM public."Order" o USING order_dups d WHERE o.id = d.id;
+    DROP TABLE order_dups;
+    CREATE UNIQUE INDEX ux_order_sender_getter_origin ON public."Order"
+      (delivery_sender_id, delivery_getter_id, origin_type, origin_outer_id) NULLS NOT DISTINCT;
+  END IF;
+END
+$do$;
+
+-- האינדקס הייחודי מתחיל בשולח; למקבל, לתאריך ולרחוב צריך אינדקסים משלהם (דוחות ו-autoreturn)
+CREATE INDEX IF NOT EXISTS ix_order_getter ON public."Order" (delivery_getter_id, delivery_sender_id);
+CREATE INDEX IF NOT EXISTS ix_order_order_date ON public."Order" (order_date);
+CREATE INDEX IF NOT EXISTS ix_person_streetcode ON public.person (streetcode);
@@ -0,0 +1,113 @@
+-- שלבי קליטת תושבים: raw_residents_csv -> temp_residents_csv -> person
+CREATE OR REPLACE FUNCTION "public"."raw_to_temp_stage"() RETURNS "void" LANGUAGE "plpgsql" AS $func$
+BEGIN
+  TRUNCATE TABLE public.temp_residents_csv RESTART IDENTITY;
+  INSERT INTO public.street (streetname)
+  SELECT DISTINCT TRIM(r.streetname) FROM public.raw_residents_csv r
+  WHERE TRIM(r.streetname) IS NOT NULL AND TRIM(r.streetname) <> ''
+    AND NOT EXISTS (SELECT 1 FROM public.street s WHERE TRIM(s.streetname) = TRIM(r.streetname));
+  INSERT INTO public.temp_residents_csv (code, lastname, father_name, mother_name, streetname, streetcode, buildingnumber, entrance, apartmentnumber, email, phone, mobile, mobile2, standing_order)
+  SELECT NULLIF(regexp_replace(r.code, '[^0-9]', '', 'g'), '')::int, TRIM(r.lastname), TRIM(r.father_name), TRIM(r.mother_name), TRIM(r.streetname), s.streetcode, TRIM(r.buildingnumber), TRIM(r.entrance), TRIM(r.apartmentnumber), normalize_email(r.email), format_il_phone(r.phone), format_il_phone(r.mobile), format_il_phone(r.mobile2), r.standing_order
+  FROM public.raw_residents_csv r LEFT JOIN public.street s ON TRIM(s.streetname) = TRIM(r.streetname);
+END;
+$func$;
+
+CREATE OR REPLACE FUNCTION "public"."process_residents_csv"() RETURNS "void" LANGUAGE "plpgsql" AS $func$
+DECLARE
+    pending INT; prev_pending INT := -1;
+BEGIN
+    -- שינוי: הקפצת המונה ל-100,000 כדי לא להתנגש עם קודים ידניים (1-5000)
+    PERFORM setval('public.person_personid_seq', GREATEST((SELECT COALESCE(MAX(personid), 0) + 1 FROM public.person), 100000), false);
+
+    -- מיזוג על קבוצות במקום לולאה לכל שורה.
+    -- target_id = אדם קיים שמתעדכן, leader_id = השורה בקובץ שיוצרת את האדם (leader_id = temp_id: שורה שמוסיפה)
+    DROP TABLE IF EXISTS pg_temp.resident_match;
+    CREATE TEMP TABLE resident_match AS
+    SELECT t.temp_id, t.code, format_il_phone(t.phone) AS phone_norm, p.personid AS target_id,
+           NULL::int AS existing_phone_id, NULL::int AS leader_id
+    FROM temp_residents_csv t LEFT JOIN person p ON p.personid = t.code;
+
+    -- אדם קיים לפי טלפון: חיפוש באינדקס ix_person_phone_norm במקום סריקה של person לכל שורה
+    UPDATE resident_match m SET existing_phone_id = (SELECT MIN(p.personid) FROM person p WHERE p.phone_norm = m.phone_norm)
+    WHERE m.target_id IS NULL AND m.phone_norm IS NOT NULL;
+
+    CREATE INDEX ON resident_match (code);
+    CREATE INDEX ON resident_match (phone_norm);
+    ANALYZE resident_match;
+
+    -- כפילויות בתוך הקובץ, בדיוק כמו הלולאה לפי סדר השורות: שורה מוסיפה רק אם אין שורה קודמת שהוסיפה
+    -- אותו קוד או אותו טלפון. כל סבב מכריע לפחות את השורה הראשונה שלא הוכרעה, ובפועל נדרשים סבבים בודדים.
+    LOOP
+        SELECT COUNT(*) INTO pending FROM resident_match WHERE target_id IS NULL AND leader_id IS NULL;
+        EXIT WHEN pending = 0;
+        IF pending = prev_pending THEN RAISE EXCEPTION 'process_residents_csv: no progress (% rows pending)', pending; END IF;
+        prev_pending := pending;
+
+        -- א. הוספה: ראשונה מבין הפתוחות בקבוצת הקוד ובקבוצת הטלפון, וטלפון שלא שייך לאף אחד
+        UPDATE resident_match m SET leader_id = m.temp_id
+        FROM (SELECT temp_id, code, phone_norm,
+                     MIN(temp_id) OVER (PARTITION BY code) AS first_code,
+                     MIN(temp_id) OVER (PARTITION BY phone_norm) AS first_phone
+              FROM resident_match WHERE target_id IS NULL AND leader_id IS NULL) w
+        WHERE m.temp_id = w.temp_id AND m.existing_phone_id IS NULL
+          AND (w.code IS NULL OR w.first_code = w.temp_id)
+          AND (w.phone_norm IS NULL OR w.first_phone = w.temp_id)
+          AND NOT EXISTS (SELECT 1 FROM resident_match i WHERE i.leader_id = i.temp_id AND i.phone_norm = m.phone_norm);
+
+        -- ב. קוד שכבר נוסף מהקובץ
+        UPDATE resident_match m SET leader_id = i.temp_id
+        FROM resident_match i
+        WHERE m.target_id IS NULL AND m.leader_id IS NULL AND i.leader_id = i.temp_id AND i.code = m.code;
+
+        -- ג. טלפון (אדם קיים, אחרת שורה שנוספה) - רק כשאין שורה קודמת פתוחה עם אותו קוד
+        UPDATE resident_match m SET target_id = m.existing_phone_id
+        WHERE m.target_id IS NULL AND m.leader_id IS NULL AND m.existing_phone_id IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM resident_match e WHERE e.target_id IS NULL AND e.leader_id IS NULL
+                          AND e.code = m.code AND e.temp_id < m.temp_id);
+        UPDATE resident_match m SET leader_id = i.temp_id
+        FROM resident_match i
+        WHERE m.target_id IS NULL AND m.leader_id IS NULL AND i.leader_id = i.temp_id AND i.phone_norm = m.phone_norm
+          AND NOT EXISTS (SELECT 1 FROM resident_match e WHERE e.target_id IS NULL AND e.leader_id IS NULL
+                          AND e.code = m.code AND e.temp_id < m.temp_id);
+    END LOOP;
+
+    -- מזהים לחדשים: קוד מהקובץ, אחרת מהמונה לפי סדר השורות
+    UPDATE resident_match SET target_id = code WHERE leader_id = temp_id AND code IS NOT NULL;
+    UPDATE resident_match m SET target_id = n.new_id
+    FROM (SELECT temp_id, nextval('public.person_personid_seq') AS new_id
+          FROM (SELECT temp_id FROM resident_match WHERE leader_id = temp_id AND code IS NULL ORDER BY temp_id) x) n
+    WHERE m.temp_id = n.temp_id;
+
+    INSERT INTO person(personid, lastname, father_name, mother_name, streetcode, buildingnumber, entrance, apartmentnumber, phone, mobile, mobile2, email, standing_order)
+    SELECT m.target_id, t.lastname, t.father_name, t.mother_name, t.streetcode, t.buildingnumber, t.entrance, t.apartmentnumber, t.phone, t.mobile, t.mobile2, t.email, t.standing_order
+    FROM resident_match m JOIN temp_residents_csv t ON t.temp_id = m.temp_id
+    WHERE m.leader_id = m.temp_id
+    ORDER BY m.temp_id
+    ON CONFLICT (personid) DO UPDATE SET lastname = EXCLUDED.lastname;
+
+    UPDATE resident_match m SET target_id = l.target_id
+    FROM resident_match l
+    WHERE m.target_id IS NULL AND l.temp_id = m.leader_id;
+
+    -- עדכון מרוכז: לכל אדם הערך האחרון שאינו NULL, כמו רצף ה-UPDATE בלולאה
+    UPDATE person p SET
+        lastname = COALESCE(u.lastname, p.lastname),
+        email = COALESCE(u.email, p.email),
+        standing_order = COALESCE(u.standing_order, p.standing_order),
+        streetcode = COALESCE(u.streetcode, p.streetcode)
+    FROM (SELECT m.target_id,
+                 (array_agg(t.lastname ORDER BY t.temp_id DESC) FILTER (WHERE t.lastname IS NOT NULL))[1] AS lastname,
+                 (array_agg(t.email ORDER BY t.temp_id DESC) FILTER (WHERE t.email IS NOT NULL))[1] AS email,
+                 (array_agg(t.standing_order ORDER BY t.temp_id DESC) FILTER (WHERE t.standing_order IS NOT NULL))[1] AS standing_order,
+                 (array_agg(t.streetcode ORDER BY t.temp_id DESC) FILTER (WHERE t.streetcode IS NOT NULL))[1] AS streetcode
+          FROM resident_match m JOIN temp_residents_csv t ON t.temp_id = m.temp_id
+          WHERE m.leader_id IS DISTINCT FROM m.temp_id
+          GROUP BY m.target_id) u
+    WHERE p.personid = u.target_id;
+
+    UPDATE temp_residents_csv t SET status = CASE WHEN m.leader_id = m.temp_id THEN 'נוסף' ELSE 'עודכן' END
+    FROM resident_match m WHERE m.temp_id = t.temp_id;
+
+    DROP TABLE pg_temp.resident_match;
+END;
+$func$;
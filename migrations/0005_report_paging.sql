@@ -0,0 +1,106 @@
+-- דפדוף keyset וחיפוש בדוחות.
+-- חיפוש LIKE '%...%' על שם משפחה ושם רחוב דרך אינדקסי trigram
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS ix_person_lastname_trgm ON public.person USING gin (lastname gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS ix_street_streetname_trgm ON public.street USING gin (streetname gin_trgm_ops);
+
+-- מפתח הדפדוף של הדוחות לפי משפחה: (שם משפחה, מזהה)
+CREATE INDEX IF NOT EXISTS ix_person_lastname_key ON public.person ((COALESCE(lastname, '')), personid);
+
+-- הדוחות לפי משפחה מחושבים לכל אדם בנפרד (LATERAL על האינדקסים של "Order") במקום GROUP BY על כל הטבלה,
+-- כך שעמוד של 50 משפחות קורא רק את ההזמנות שלהן. הסדר נקבע בשאילתת הדוח (REPORT_PAGING), לא ב-view.
+CREATE OR REPLACE VIEW public.v_families_balance AS
+ SELECT p.personid,
+    p.lastname,
+    s.sent,
+    r.received,
+    (s.sent - r.received) AS balance
+   FROM public.person p
+     CROSS JOIN LATERAL ( SELECT count(*) AS sent FROM public."Order" o WHERE o.delivery_sender_id = p.personid) s
+     CROSS JOIN LATERAL ( SELECT count(*) AS received FROM public."Order" o WHERE o.delivery_getter_id = p.personid) r;
+
+CREATE OR REPLACE VIEW public.v_family_receipts AS
+ SELECT p.personid,
+    p.lastname,
+    p.autoreturn,
+    r.total_received,
+    r.received_regular,
+    r.received_autoreturn
+   FROM public.person p
+     CROSS JOIN LATERAL ( SELECT count(o.id) AS total_received,
+            count(*) FILTER (WHERE o.origin_type <> 'autoreturn'::text) AS received_regular,
+            count(*) FILTER (WHERE o.origin_type = 'autoreturn'::text) AS received_autoreturn
+           FROM public."Order" o
+          WHERE o.delivery_getter_id = p.personid) r;
+
+CREATE OR REPLACE VIEW public.v_accounts_summary AS
+ SELECT s.personid AS sender_id,
+    s.lastname AS sender_name,
+    a.total_orders,
+    a.total_amount,
+        CASE
+            WHEN a.total_amount > 360::numeric THEN 20
+            WHEN a.total_amount > 180::numeric THEN 10
+            ELSE 5
+        END AS discount_percent,
+    round(a.total_amount *
+        CASE
+            WHEN a.total_amount > 360::numeric THEN 0.20
+            WHEN a.total_amount > 180::numeric THEN 0.10
+            ELSE 0.05
+        END, 2) AS discount_amount,
+    round(a.total_amount *
+        CASE
+            WHEN a.total_amount > 360::numeric THEN 0.80
+            WHEN a.total_amount > 180::numeric THEN 0.90
+            ELSE 0.95
+        END, 2) AS final_amount
+   FROM public.person s
+     CROSS JOIN LATERAL ( SELECT count(o.id) AS total_orders, COALESCE(sum(o.price), 0::numeric) AS total_amount
+           FROM public."Order" o
+          WHERE o.delivery_sender_id = s.personid) a
+  WHERE a.total_orders > 0;
+
+-- שאר הדוחות: בלי ORDER BY ב-view (מונע מיון של הכל לפני הדפדוף), ומזהה תושב לדוח הרחובות כמפתח ייחודי
+CREATE OR REPLACE VIEW public.v_orders_details AS
+ SELECT o.id,
+    s.lastname AS sender_name,
+    g.lastname AS getter_name,
+    o.package_size,
+    o.price,
+    o.order_date,
+    o.origin_type
+   FROM public."Order" o
+     JOIN public.person s ON s.personid = o.delivery_sender_id
+     JOIN public.person g ON g.personid = o.delivery_getter_id;
+
+CREATE OR REPLACE VIEW public.v_packages_per_building AS
+ SELECT st.streetname,
+    p.buildingnumber,
+    count(o.id) AS total_orders,
+    sum(CASE WHEN o.package_size = 'סמלי'::text THEN 1 ELSE 0 END) AS symbolic_count,
+    sum(CASE WHEN o.package_size = 'מכובד'::text THEN 1 ELSE 0 END) AS respectable_count,
+    sum(CASE WHEN o.package_size = 'מפואר'::text THEN 1 ELSE 0 END) AS fancy_count
+   FROM public."Order" o
+     JOIN public.person p ON p.personid = o.delivery_getter_id
+     JOIN public.street st ON st.streetcode = p.streetcode
+  GROUP BY st.streetname, p.buildingnumber;
+
+CREATE OR REPLACE VIEW public.v_residents_by_street AS
+ SELECT st.streetname,
+    p.lastname,
+    p.buildingnumber,
+    p.apartmentnumber,
+    p.phone,
+    p.mobile,
+    p.personid
+   FROM public.person p
+     JOIN public.street st ON st.streetcode = p.streetcode;
+
+CREATE OR REPLACE VIEW public.v_outer_distribution_status AS
+ SELECT id, sender_code, getter_code, package_size, created_at
+   FROM public.outerapporder oao;
+
+CREATE OR REPLACE VIEW public.v_outerapporder_full_summary AS
+ SELECT id, sender_code, getter_code, invitees, package_size, origin, created_at
+   FROM public.outerapporder oao;
@@ -0,0 +1,266 @@
+-- סיכומים מצטברים מעל "Order": לכל אדם (נשלחו/התקבלו/סכום) ולכל בניין (חבילות לפי גודל).
+-- הדוחות קוראים מהטבלאות האלה במקום GROUP BY על כל ההזמנות. הטבלאות מתעדכנות בטריגרים ברמת פקודה
+-- (transition tables): פקודת INSERT אחת של הפצה = upsert אחד מקובץ לכל אדם/בניין שהשתנה.
+CREATE TABLE IF NOT EXISTS public.person_order_totals (
+    personid integer PRIMARY KEY,
+    sent bigint NOT NULL DEFAULT 0,
+    sent_amount numeric NOT NULL DEFAULT 0,
+    received bigint NOT NULL DEFAULT 0,
+    received_regular bigint NOT NULL DEFAULT 0,
+    received_autoreturn bigint NOT NULL DEFAULT 0,
+    received_symbolic bigint NOT NULL DEFAULT 0,
+    received_respectable bigint NOT NULL DEFAULT 0,
+    received_fancy bigint NOT NULL DEFAULT 0
+);
+
+-- בניין = הכתובת הנוכחית של המקבל (כמו ב-v_packages_per_building). מעבר דירה מעביר את הספירות שלו.
+CREATE TABLE IF NOT EXISTS public.building_order_totals (
+    streetcode integer NOT NULL,
+    buildingnumber text,
+    total_orders bigint NOT NULL DEFAULT 0,
+    symbolic_count bigint NOT NULL DEFAULT 0,
+    respectable_count bigint NOT NULL DEFAULT 0,
+    fancy_count bigint NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_building_order_totals ON public.building_order_totals (streetcode, buildingnumber) NULLS NOT DISTINCT;
+
+-- אותם סיכומים מחושבים מאפס: מקור האתחול, rebuild_order_totals() ובדיקת העקביות (flask --app app check-totals)
+CREATE OR REPLACE VIEW public.v_person_order_totals_live AS
+ SELECT COALESCE(s.personid, r.personid) AS personid,
+    COALESCE(s.sent, 0) AS sent,
+    COALESCE(s.sent_amount, 0) AS sent_amount,
+    COALESCE(r.received, 0) AS received,
+    COALESCE(r.received_regular, 0) AS received_regular,
+    COALESCE(r.received_autoreturn, 0) AS received_autoreturn,
+    COALESCE(r.received_symbolic, 0) AS received_symbolic,
+    COALESCE(r.received_respectable, 0) AS received_respectable,
+    COALESCE(r.received_fancy, 0) AS received_fancy
+   FROM ( SELECT o.delivery_sender_id AS personid, count(*) AS sent, COALESCE(sum(o.price), 0) AS sent_amount
+           FROM public."Order" o WHERE o.delivery_sender_id IS NOT NULL
+          GROUP BY o.delivery_sender_id) s
+     FULL JOIN ( SELECT o.delivery_getter_id AS personid, count(*) AS received,
+            count(*) FILTER (WHERE o.origin_type <> 'autoreturn'::text) AS received_regular,
+            count(*) FILTER (WHERE o.origin_type = 'autoreturn'::text) AS received_autoreturn,
+            count(*) FILTER (WHERE o.package_size = 'סמלי'::text) AS received_symbolic,
+            count(*) FILTER (WHERE o.package_size = 'מכובד'::text) AS received_respectable,
+            count(*) FILTER (WHERE o.package_size = 'מפואר'::text) AS received_fancy
+           FROM public."Order" o WHERE o.delivery_getter_id IS NOT NULL
+          GROUP BY o.delivery_getter_id) r ON r.personid = s.personid;
+
+CREATE OR REPLACE VIEW public.v_building_order_totals_live AS
+ SELECT p.streetcode,
+    p.buildingnumber,
+    count(*) AS total_orders,
+    count(*) FILTER (WHERE o.package_size = 'סמלי'::text) AS symbolic_count,
+    count(*) FILTER (WHERE o.package_size = 'מכובד'::text) AS respectable_count,
+    count(*) FILTER (WHERE o.package_size = 'מפואר'::text) AS fancy_count
+   FROM public."Order" o
+     JOIN public.person p ON p.personid = o.delivery_getter_id
+  WHERE p.streetcode IS NOT NULL
+  GROUP BY p.streetcode, p.buildingnumber;
+
+CREATE OR REPLACE FUNCTION public.rebuild_order_totals() RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  -- SHARE: הזמנות חדשות ממתינות עד סוף הבנייה מחדש, קריאות ממשיכות
+  LOCK TABLE public."Order", public.person IN SHARE MODE;
+  TRUNCATE public.person_order_totals, public.building_order_totals;
+  INSERT INTO public.person_order_totals (personid, sent, sent_amount, received, received_regular, received_autoreturn,
+                                          received_symbolic, received_respectable, received_fancy)
+  SELECT personid, sent, sent_amount, received, received_regular, received_autoreturn,
+         received_symbolic, received_respectable, received_fancy
+  FROM public.v_person_order_totals_live;
+  INSERT INTO public.building_order_totals (streetcode, buildingnumber, total_orders, symbolic_count, respectable_count, fancy_count)
+  SELECT streetcode, buildingnumber, total_orders, symbolic_count, respectable_count, fancy_count
+  FROM public.v_building_order_totals_live;
+END;
+$$;
+
+-- דלתא של פקודה על "Order": השורות החדשות בסימן +1 והישנות בסימן -1 (UPDATE = שתיהן)
+CREATE OR REPLACE FUNCTION public.order_totals_apply() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  delta text;
+BEGIN
+  delta := CASE TG_OP
+    WHEN 'INSERT' THEN 'SELECT n.*, 1 AS sign FROM new_rows n'
+    WHEN 'DELETE' THEN 'SELECT o.*, -1 AS sign FROM old_rows o'
+    ELSE 'SELECT n.*, 1 AS sign FROM new_rows n UNION ALL SELECT o.*, -1 FROM old_rows o' END;
+
+  EXECUTE format($q$
+    INSERT INTO public.person_order_totals AS t (personid, sent, sent_amount, received, received_regular, received_autoreturn,
+                                                 received_symbolic, received_respectable, received_fancy)
+    SELECT personid, sum(sent), sum(sent_amount), sum(received), sum(received_regular), sum(received_autoreturn),
+           sum(received_symbolic), sum(received_respectable), sum(received_fancy)
+    FROM (
+      SELECT d.delivery_sender_id AS personid, d.sign AS sent, d.sign * COALESCE(d.price, 0) AS sent_amount, 0 AS received,
+             0 AS received_regular, 0 AS received_autoreturn, 0 AS received_symbolic, 0 AS received_respectable, 0 AS received_fancy
+      FROM (%1$s) d WHERE d.delivery_sender_id IS NOT NULL
+      UNION ALL
+      SELECT d.delivery_getter_id, 0, 0, d.sign,
+             CASE WHEN d.origin_type <> 'autoreturn' THEN d.sign ELSE 0 END,
+             CASE WHEN d.origin_type = 'autoreturn' THEN d.sign ELSE 0 END,
+             CASE WHEN d.package_size = 'סמלי' THEN d.sign ELSE 0 END,
+             CASE WHEN d.package_size = 'מכובד' THEN d.sign ELSE 0 END,
+             CASE WHEN d.package_size = 'מפואר' THEN d.sign ELSE 0 END
+      FROM (%1$s) d WHERE d.delivery_getter_id IS NOT NULL
+    ) x
+    GROUP BY personid
+    HAVING (sum(sent), sum(sent_amount), sum(received), sum(received_regular), sum(received_autoreturn),
+            sum(received_symbolic), sum(received_respectable), sum(received_fancy)) <> (0, 0, 0, 0, 0, 0, 0, 0)
+    ORDER BY personid
+    ON CONFLICT (personid) DO UPDATE SET
+      sent = t.sent + EXCLUDED.sent,
+      sent_amount = t.sent_amount + EXCLUDED.sent_amount,
+      received = t.received + EXCLUDED.received,
+      received_regular = t.received_regular + EXCLUDED.received_regular,
+      received_autoreturn = t.received_autoreturn + EXCLUDED.received_autoreturn,
+      received_symbolic = t.received_symbolic + EXCLUDED.received_symbolic,
+      received_respectable = t.received_respectable + EXCLUDED.received_respectable,
+      received_fancy = t.received_fancy + EXCLUDED.received_fancy
+  $q$, delta);
+
+  EXECUTE format($q$
+    INSERT INTO public.building_order_totals AS t (streetcode, buildingnumber, total_orders, symbolic_count, respectable_count, fancy_count)
+    SELECT p.streetcode, p.buildingnumber, sum(d.sign),
+           sum(CASE WHEN d.package_size = 'סמלי' THEN d.sign ELSE 0 END),
+           sum(CASE WHEN d.package_size = 'מכובד' THEN d.sign ELSE 0 END),
+           sum(CASE WHEN d.package_size = 'מפואר' THEN d.sign ELSE 0 END)
+    FROM (%1$s) d
+      JOIN public.person p ON p.personid = d.delivery_getter_id
+    WHERE p.streetcode IS NOT NULL
+    GROUP BY p.streetcode, p.buildingnumber
+    HAVING (sum(d.sign), sum(CASE WHEN d.package_size = 'סמלי' THEN d.sign ELSE 0 END),
+            sum(CASE WHEN d.package_size = 'מכובד' THEN d.sign ELSE 0 END),
+            sum(CASE WHEN d.package_size = 'מפואר' THEN d.sign ELSE 0 END)) <> (0, 0, 0, 0)
+    ORDER BY p.streetcode, p.buildingnumber
+    ON CONFLICT (streetcode, buildingnumber) DO UPDATE SET
+      total_orders = t.total_orders + EXCLUDED.total_orders,
+      symbolic_count = t.symbolic_count + EXCLUDED.symbolic_count,
+      respectable_count = t.respectable_count + EXCLUDED.respectable_count,
+      fancy_count = t.fancy_count + EXCLUDED.fancy_count
+  $q$, delta);
+  RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION public.order_totals_truncate() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  TRUNCATE public.person_order_totals, public.building_order_totals;
+  RETURN NULL;
+END;
+$$;
+
+-- מעבר כתובת של מקבל: הספירות שלו עוברות מהבניין הישן לחדש
+CREATE OR REPLACE FUNCTION public.person_totals_move() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  INSERT INTO public.building_order_totals AS t (streetcode, buildingnumber, total_orders, symbolic_count, respectable_count, fancy_count)
+  SELECT streetcode, buildingnumber, sum(total_orders), sum(symbolic_count), sum(respectable_count), sum(fancy_count)
+  FROM (
+    SELECT n.streetcode, n.buildingnumber, pt.received AS total_orders, pt.received_symbolic AS symbolic_count,
+           pt.received_respectable AS respectable_count, pt.received_fancy AS fancy_count
+    FROM old_rows o
+      JOIN new_rows n ON n.personid = o.personid
+      JOIN public.person_order_totals pt ON pt.personid = n.personid
+    WHERE (o.streetcode, o.buildingnumber) IS DISTINCT FROM (n.streetcode, n.buildingnumber)
+      AND pt.received <> 0 AND n.streetcode IS NOT NULL
+    UNION ALL
+    SELECT o.streetcode, o.buildingnumber, -pt.received, -pt.received_symbolic, -pt.received_respectable, -pt.received_fancy
+    FROM old_rows o
+      JOIN new_rows n ON n.personid = o.personid
+      JOIN public.person_order_totals pt ON pt.personid = o.personid
+    WHERE (o.streetcode, o.buildingnumber) IS DISTINCT FROM (n.streetcode, n.buildingnumber)
+      AND pt.received <> 0 AND o.streetcode IS NOT NULL
+  ) m
+  GROUP BY streetcode, buildingnumber
+  ORDER BY streetcode, buildingnumber
+  ON CONFLICT (streetcode, buildingnumber) DO UPDATE SET
+    total_orders = t.total_orders + EXCLUDED.total_orders,
+    symbolic_count = t.symbolic_count + EXCLUDED.symbolic_count,
+    respectable_count = t.respectable_count + EXCLUDED.respectable_count,
+    fancy_count = t.fancy_count + EXCLUDED.fancy_count;
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS order_totals_insert ON public."Order";
+DROP TRIGGER IF EXISTS order_totals_update ON public."Order";
+DROP TRIGGER IF EXISTS order_totals_delete ON public."Order";
+DROP TRIGGER IF EXISTS order_totals_truncate ON public."Order";
+DROP TRIGGER IF EXISTS person_totals_move ON public.person;
+CREATE TRIGGER order_totals_insert AFTER INSERT ON public."Order"
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION public.order_totals_apply();
+CREATE TRIGGER order_totals_update AFTER UPDATE ON public."Order"
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION public.order_totals_apply();
+CREATE TRIGGER order_totals_delete AFTER DELETE ON public."Order"
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION public.order_totals_apply();
+CREATE TRIGGER order_totals_truncate AFTER TRUNCATE ON public."Order"
+    FOR EACH STATEMENT EXECUTE FUNCTION public.order_totals_truncate();
+CREATE TRIGGER person_totals_move AFTER UPDATE ON public.person
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION public.person_totals_move();
+
+SELECT public.rebuild_order_totals();
+
+-- הדוחות קוראים מהסיכומים (שמות וסוגי העמודות כמו קודם)
+CREATE OR REPLACE VIEW public.v_families_balance AS
+ SELECT p.personid,
+    p.lastname,
+    COALESCE(t.sent, 0) AS sent,
+    COALESCE(t.received, 0) AS received,
+    (COALESCE(t.sent, 0) - COALESCE(t.received, 0)) AS balance
+   FROM public.person p
+     LEFT JOIN public.person_order_totals t ON t.personid = p.personid;
+
+CREATE OR REPLACE VIEW public.v_family_receipts AS
+ SELECT p.personid,
+    p.lastname,
+    p.autoreturn,
+    COALESCE(t.received, 0) AS total_received,
+    COALESCE(t.received_regular, 0) AS received_regular,
+    COALESCE(t.received_autoreturn, 0) AS received_autoreturn
+   FROM public.person p
+     LEFT JOIN public.person_order_totals t ON t.personid = p.personid;
+
+CREATE OR REPLACE VIEW public.v_accounts_summary AS
+ SELECT s.personid AS sender_id,
+    s.lastname AS sender_name,
+    a.sent AS total_orders,
+    a.sent_amount AS total_amount,
+        CASE
+            WHEN a.sent_amount > 360::numeric THEN 20
+            WHEN a.sent_amount > 180::numeric THEN 10
+            ELSE 5
+        END AS discount_percent,
+    round(a.sent_amount *
+        CASE
+            WHEN a.sent_amount > 360::numeric THEN 0.20
+            WHEN a.sent_amount > 180::numeric THEN 0.10
+            ELSE 0.05
+        END, 2) AS discount_amount,
+    round(a.sent_amount *
+        CASE
+            WHEN a.sent_amount > 360::numeric THEN 0.80
+            WHEN a.sent_amount > 180::numeric THEN 0.90
+            ELSE 0.95
+        END, 2) AS final_amount
+   FROM public.person s
+     JOIN public.person_order_totals a ON a.personid = s.personid
+  WHERE a.sent > 0;
+
+CREATE OR REPLACE VIEW public.v_packages_per_building AS
+ SELECT st.streetname,
+    b.buildingnumber,
+    sum(b.total_orders)::bigint AS total_orders,
+    sum(b.symbolic_count)::bigint AS symbolic_count,
+    sum(b.respectable_count)::bigint AS respectable_count,
+    sum(b.fancy_count)::bigint AS fancy_count
+   FROM public.building_order_totals b
+     JOIN public.street st ON st.streetcode = b.streetcode
+  WHERE b.total_orders > 0
+  GROUP BY st.streetname, b.buildingnumber;
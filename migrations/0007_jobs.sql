@@ -0,0 +1,20 @@
+-- עבודות רקע (קליטת תושבים, טעינת הזמנות, הפצה): מצב והתקדמות לכל עבודה, גלויים לכל תהליך של האפליקציה.
+-- status: queued -> running -> done / failed / cancelled
+CREATE TABLE IF NOT EXISTS public.jobs (
+    id bigserial PRIMARY KEY,
+    kind text NOT NULL,
+    status text NOT NULL DEFAULT 'queued',
+    phase text,
+    rows_done bigint NOT NULL DEFAULT 0,
+    rows_total bigint,
+    messages text[] NOT NULL DEFAULT '{}',
+    error text,
+    cancel_requested boolean NOT NULL DEFAULT false,
+    backend_pid integer,
+    created_at timestamp with time zone NOT NULL DEFAULT now(),
+    started_at timestamp with time zone,
+    updated_at timestamp with time zone,
+    finished_at timestamp with time zone
+);
+
+CREATE INDEX IF NOT EXISTS ix_jobs_active ON public.jobs (kind) WHERE status IN ('queued', 'running');
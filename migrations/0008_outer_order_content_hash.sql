@@ -0,0 +1,20 @@
+-- מניעת כפילויות בהעלאת קובץ הזמנות: hash של תוכן ההזמנה (שולח, מוזמנים, טלפון, גודל חבילה) עם אינדקס ייחודי.
+-- העלאה חוזרת של אותו ייצוא מהאפליקציה מוסיפה רק שורות חדשות (ON CONFLICT DO NOTHING).
+ALTER TABLE public.outerapporder ADD COLUMN IF NOT EXISTS content_hash uuid;
+
+CREATE OR REPLACE FUNCTION public.outer_order_hash(sender_code text, invitees text, sender_phone text, package_size text) RETURNS uuid
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$
+  -- chr(31) מפריד בין השדות, COALESCE שומר על המיקום של שדה ריק
+  SELECT md5(concat_ws(chr(31), COALESCE(sender_code, ''), COALESCE(invitees, ''),
+                       COALESCE(sender_phone, ''), COALESCE(package_size, '')))::uuid
+$$;
+
+-- הזמנות קיימות: רק הראשונה מכל קבוצה זהה מקבלת hash (כפילויות ישנות נשארות, אבל לא חוסמות את האינדקס)
+UPDATE public.outerapporder o SET content_hash = f.h
+FROM (SELECT min(id) AS id, public.outer_order_hash(sender_code, invitees, sender_phone, package_size) AS h
+      FROM public.outerapporder
+      GROUP BY 2) f
+WHERE o.id = f.id AND o.content_hash IS NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_outerapporder_content_hash ON public.outerapporder (content_hash);
@@ -0,0 +1,3 @@
+-- הזמנות שעוד לא הופצו: אינדקס חלקי קטן (רוב הטבלה כבר processed), כך שספירת הממתינות בלוח הבקרה
+-- ובחירת השורות להפצה לא סורקות את כל outerapporder.
+CREATE INDEX IF NOT EXISTS ix_outerapporder_pending ON public.outerapporder (status) WHERE status IN ('waiting', 'error');
@@ -0,0 +1,165 @@
+-- זיהוי רחובות לפי מפתח מנורמל: רווחים, גרש/גרשיים/מרכאות, מקף ונקודה לא יוצרים רחוב כפול.
+-- street.street_key עם אינדקס ייחודי, street_alias לכתיב שגוי שמופה ידנית לרחוב קיים, ו-raw_to_temp_stage עם hash join אחד.
+-- המיגרציה לא מאחדת רחובות בעצמה: קבוצות שמתנגשות על אותו מפתח מופיעות ב-v_street_key_conflicts ומאוחדות ידנית.
+CREATE OR REPLACE FUNCTION public.street_key(p_name text) RETURNS text
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$
+  SELECT NULLIF(btrim(regexp_replace(regexp_replace(lower(p_name), '[''"`׳״‘’“”]', '', 'g'), '[\s._,/–-]+', ' ', 'g')), '')
+$$;
+
+ALTER TABLE public.street ADD COLUMN IF NOT EXISTS street_key text;
+
+-- כל הכנסה/שינוי שם: השם נשמר בלי רווחים מיותרים והמפתח מחושב ממנו.
+-- שינוי שם לשם של רחוב אחר נכשל עם הודעה ברורה (הכנסה נשארת ל-ON CONFLICT של הקליטה)
+CREATE OR REPLACE FUNCTION public.street_canonicalize() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  other integer;
+BEGIN
+  NEW.streetname := NULLIF(regexp_replace(btrim(NEW.streetname), '\s+', ' ', 'g'), '');
+  NEW.street_key := public.street_key(NEW.streetname);
+  IF TG_OP = 'UPDATE' THEN
+    SELECT streetcode INTO other FROM public.street WHERE street_key = NEW.street_key AND streetcode <> NEW.streetcode;
+    IF other IS NOT NULL THEN
+      RAISE EXCEPTION 'הרחוב "%" כבר קיים (קוד %) - לאחד עם add_street_alias', NEW.streetname, other;
+    END IF;
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS street_canonicalize ON public.street;
+CREATE TRIGGER street_canonicalize BEFORE INSERT OR UPDATE OF streetname ON public.street
+    FOR EACH ROW EXECUTE FUNCTION public.street_canonicalize();
+
+-- מפתחות לרחובות הקיימים (בלי הטריגר, כדי שרחובות כפולים לא יכשילו את העדכון).
+-- בכל קבוצה עם אותו מפתח רק הרחוב עם הכי הרבה תושבים מקבל את המפתח; השאר נשארים בלי מפתח עד שמאחדים אותם
+ALTER TABLE public.street DISABLE TRIGGER street_canonicalize;
+UPDATE public.street s SET street_key = k.key
+FROM (SELECT streetcode, key,
+             row_number() OVER (PARTITION BY key ORDER BY residents DESC, streetcode) AS rn
+      FROM (SELECT s.streetcode, public.street_key(s.streetname) AS key,
+                   (SELECT count(*) FROM public.person p WHERE p.streetcode = s.streetcode) AS residents
+            FROM public.street s) x) k
+WHERE s.streetcode = k.streetcode AND k.rn = 1 AND k.key IS NOT NULL;
+ALTER TABLE public.street ENABLE TRIGGER street_canonicalize;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_street_key ON public.street (street_key);
+
+-- רחובות שהשם שלהם נותן אותו מפתח: לבדיקה ולאיחוד עם add_street_alias(streetname, streetcode של הרחוב הנכון)
+CREATE OR REPLACE VIEW public.v_street_key_conflicts AS
+ SELECT c.key AS street_key, s.streetcode, s.streetname, s.street_key IS NOT NULL AS active,
+    (SELECT count(*) FROM public.person p WHERE p.streetcode = s.streetcode) AS residents
+   FROM (SELECT public.street_key(streetname) AS key FROM public.street GROUP BY 1 HAVING count(*) > 1) c
+     JOIN public.street s ON public.street_key(s.streetname) = c.key;
+
+CREATE TABLE IF NOT EXISTS public.street_alias (
+    alias_key text PRIMARY KEY,
+    alias text NOT NULL,
+    streetcode integer NOT NULL REFERENCES public.street (streetcode) ON DELETE CASCADE,
+    created_at timestamp without time zone DEFAULT now()
+);
+
+-- העברת כל התושבים מרחוב כפול לרחוב הנכון ומחיקת הכפול. אם תושב כבר קיים ברחוב הנכון (אותו בניין, דירה וטלפון)
+-- האיחוד נכשל - קודם מטפלים בתושב הכפול. מחזיר כמה תושבים הועברו.
+CREATE OR REPLACE FUNCTION public.merge_street(p_from integer, p_into integer) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  moved integer;
+  clashes integer;
+  example integer;
+BEGIN
+  SELECT count(*), min(p.personid) INTO clashes, example
+  FROM public.person p JOIN public.person q
+    ON q.streetcode = p_into AND q.buildingnumber = p.buildingnumber
+   AND COALESCE(q.apartmentnumber, '') = COALESCE(p.apartmentnumber, '') AND q.phone_key = p.phone_key
+  WHERE p.streetcode = p_from;
+  IF clashes > 0 THEN
+    RAISE EXCEPTION 'לא ניתן לאחד את רחוב % לרחוב %: % תושבים קיימים בשניהם (אותו בניין, דירה וטלפון), למשל personid %',
+      p_from, p_into, clashes, example;
+  END IF;
+  UPDATE public.person SET streetcode = p_into WHERE streetcode = p_from;
+  GET DIAGNOSTICS moved = ROW_COUNT;
+  UPDATE public.street_alias SET streetcode = p_into WHERE streetcode = p_from;
+  DELETE FROM public.building_order_totals WHERE streetcode = p_from AND total_orders = 0;
+  DELETE FROM public.street WHERE streetcode = p_from;
+  RETURN moved;
+END;
+$$;
+
+-- כתיב שגוי -> רחוב קיים. רחובות שכבר נוצרו מהכתיב הזה (כולל כפולים בלי מפתח מ-v_street_key_conflicts)
+-- מתאחדים לרחוב הנכון, והכתיב נשמר ב-street_alias לקליטות הבאות.
+CREATE OR REPLACE FUNCTION public.add_street_alias(p_alias text, p_streetcode integer) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  k text := public.street_key(p_alias);
+  target_key text;
+  dup integer;
+  moved integer := 0;
+  merged integer := 0;
+BEGIN
+  IF k IS NULL THEN RAISE EXCEPTION 'שם רחוב ריק'; END IF;
+  SELECT street_key INTO target_key FROM public.street WHERE streetcode = p_streetcode;
+  IF NOT FOUND THEN RAISE EXCEPTION 'רחוב % לא קיים', p_streetcode; END IF;
+  FOR dup IN SELECT streetcode FROM public.street
+             WHERE streetcode <> p_streetcode AND (street_key = k OR (street_key IS NULL AND public.street_key(streetname) = k))
+             ORDER BY streetcode
+  LOOP
+    moved := moved + public.merge_street(dup, p_streetcode);
+    merged := merged + 1;
+  END LOOP;
+  -- רחוב יעד שהיה כפול בלי מפתח מקבל את המפתח שלו אחרי שהכפולים אוחדו
+  IF target_key IS NULL THEN
+    UPDATE public.street SET street_key = public.street_key(streetname) WHERE streetcode = p_streetcode
+    RETURNING street_key INTO target_key;
+  END IF;
+  IF k IS DISTINCT FROM target_key THEN
+    INSERT INTO public.street_alias (alias_key, alias, streetcode) VALUES (k, p_alias, p_streetcode)
+    ON CONFLICT (alias_key) DO UPDATE SET alias = EXCLUDED.alias, streetcode = EXCLUDED.streetcode, created_at = now();
+  ELSIF merged = 0 AND NOT EXISTS (SELECT 1 FROM public.street_alias WHERE alias_key = k) THEN
+    RAISE EXCEPTION '"%" כבר מזוהה כרחוב %', p_alias, p_streetcode;
+  END IF;
+  DELETE FROM public.missing_streets_log WHERE public.street_key(streetname) = k;
+  RETURN moved;
+END;
+$$;
+
+-- כל כתיב שונה בקובץ מזוהה פעם אחת (לפי street_key ואז street_alias), והשורות מצטרפות אליו ב-hash join על השם,
+-- במקום השוואת TRIM(streetname) מול כל רחוב לכל שורה
+CREATE OR REPLACE FUNCTION "public"."raw_to_temp_stage"() RETURNS "void" LANGUAGE "plpgsql" AS $func$
+BEGIN
+  TRUNCATE TABLE public.temp_residents_csv RESTART IDENTITY;
+
+  DROP TABLE IF EXISTS pg_temp.upload_streets;
+  CREATE TEMP TABLE upload_streets AS
+  SELECT n.raw_name, public.street_key(n.raw_name) AS street_key, NULL::integer AS streetcode
+  FROM (SELECT DISTINCT TRIM(streetname) AS raw_name FROM public.raw_residents_csv) n
+  WHERE n.raw_name <> '';
+  ANALYZE upload_streets;
+
+  -- מפתח שאין לא ברחובות ולא בכינויים = רחוב חדש, שנרשם גם ב-missing_streets_log (למיפוי אם זו טעות כתיב)
+  WITH added AS (
+    INSERT INTO public.street (streetname)
+    SELECT DISTINCT ON (u.street_key) u.raw_name FROM upload_streets u
+    WHERE u.street_key IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM public.street s WHERE s.street_key = u.street_key)
+      AND NOT EXISTS (SELECT 1 FROM public.street_alias a WHERE a.alias_key = u.street_key)
+    ORDER BY u.street_key, u.raw_name
+    ON CONFLICT (street_key) DO NOTHING
+    RETURNING streetname)
+  INSERT INTO public.missing_streets_log (streetname) SELECT streetname FROM added;
+
+  UPDATE upload_streets u SET streetcode = s.streetcode FROM public.street s WHERE s.street_key = u.street_key;
+  UPDATE upload_streets u SET streetcode = a.streetcode FROM public.street_alias a
+  WHERE a.alias_key = u.street_key AND u.streetcode IS NULL;
+
+  INSERT INTO public.temp_residents_csv (code, lastname, father_name, mother_name, streetname, streetcode, buildingnumber, entrance, apartmentnumber, email, phone, mobile, mobile2, standing_order)
+  SELECT NULLIF(regexp_replace(r.code, '[^0-9]', '', 'g'), '')::int, TRIM(r.lastname), TRIM(r.father_name), TRIM(r.mother_name), TRIM(r.streetname), u.streetcode, TRIM(r.buildingnumber), TRIM(r.entrance), TRIM(r.apartmentnumber), normalize_email(r.email), format_il_phone(r.phone), format_il_phone(r.mobile), format_il_phone(r.mobile2), r.standing_order
+  FROM public.raw_residents_csv r LEFT JOIN upload_streets u ON u.raw_name = TRIM(r.streetname);
+
+  DROP TABLE pg_temp.upload_streets;
+END;
+$func$;
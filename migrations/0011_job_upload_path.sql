@@ -0,0 +1,2 @@
+-- הקובץ שעבודה קוראת (save_upload): נמחק כשהעבודה מסתיימת, וגם אחרי הפעלה מחדש לעבודות שלא הסתיימו
+ALTER TABLE public.jobs ADD COLUMN IF NOT EXISTS upload_path text;
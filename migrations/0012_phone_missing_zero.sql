@@ -0,0 +1,32 @@
+-- מספר שאיבד את האפס המוביל (עמודת טלפון שעברה דרך Excel): 9 ספרות שמתחילות ב-5 (נייד) או 8 ספרות שמתחילות
+-- ב-2/3/4/8/9 (קווי) מקבלות '0' במקום קידומת ברירת המחדל. קודם '501234567' נפסל (11 ספרות) ו-'21234567' הפך ל-'0221234567'.
+-- אותו שינוי ב-normalize_phone באפליקציה.
+CREATE OR REPLACE FUNCTION "public"."format_il_phone"("p_text" "text", "p_default_area" "text" DEFAULT '02'::"text") RETURNS "text"
+LANGUAGE "plpgsql" IMMUTABLE PARALLEL SAFE AS $func$
+DECLARE
+    e text := p_text;
+BEGIN
+    IF e IS NULL OR btrim(e) = '' THEN RETURN NULL; END IF;
+    e := regexp_replace(e, '\D', '', 'g');
+    IF left(e,3) = '972' THEN e := '0' || substring(e FROM 4); END IF;
+    IF e ~ '^(5[0-9]{8}|[23489][0-9]{7})$' THEN e := '0' || e; END IF;
+    IF left(e,1) <> '0' THEN e := p_default_area || e; END IF;
+    e := regexp_replace(e, '^0+', '0');
+    IF length(e) = 7 THEN e := p_default_area || e; END IF;
+    IF length(e) BETWEEN 7 AND 10 THEN RETURN e; ELSE RETURN NULL; END IF;
+END;
+$func$;
+
+-- טלפונים שכבר נשמרו מנורמלים בגרסה הקודמת (raw_to_temp_stage) עם קידומת 02 מיותרת: 02 + 8 ספרות שמתחילות
+-- ב-2/3/4/8/9 הוא תמיד '0' + המספר המקורי. מספרים שנפסלו (NULL) אי אפשר לשחזר - הם יתוקנו בקליטה הבאה.
+UPDATE public.person SET
+    phone = CASE WHEN phone ~ '^02[23489][0-9]{7}$' THEN '0' || substring(phone FROM 3) ELSE phone END,
+    mobile = CASE WHEN mobile ~ '^02[23489][0-9]{7}$' THEN '0' || substring(mobile FROM 3) ELSE mobile END,
+    mobile2 = CASE WHEN mobile2 ~ '^02[23489][0-9]{7}$' THEN '0' || substring(mobile2 FROM 3) ELSE mobile2 END
+WHERE phone ~ '^02[23489][0-9]{7}$' OR mobile ~ '^02[23489][0-9]{7}$' OR mobile2 ~ '^02[23489][0-9]{7}$';
+
+-- העמודות המחושבות (מיגרציה 0002) לא מתעדכנות לבד כשהפונקציה משתנה: חישוב מחדש רק בשורות שהתוצאה שלהן שונה
+UPDATE public.person SET phone = phone, mobile = mobile, mobile2 = mobile2
+WHERE phone_norm IS DISTINCT FROM public.format_il_phone(phone)
+   OR mobile_norm IS DISTINCT FROM public.format_il_phone(mobile)
+   OR mobile2_norm IS DISTINCT FROM public.format_il_phone(mobile2);
@@ -0,0 +1,4 @@
+-- דוח התושבים לפי רחוב חוזר לסדר שלפני 0005: רחוב, בניין, משפחה (REPORT_PAGING['v_residents_by_street']).
+-- רחובות בסדר המפתח מהאינדקס, ולכל רחוב התושבים דרך ix_person_streetcode; המיון של בניין ומשפחה
+-- נעשה לכל רחוב בנפרד (Incremental Sort) ונעצר אחרי עמוד אחד, במקום מיון של כל התושבים
+CREATE INDEX IF NOT EXISTS ix_street_streetname_key ON public.street ((COALESCE(streetname, '')));
@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+from app import clean_int_column, clean_int_str, normalize_order_chunk, resolve_order_columns
+
+
+@pytest.mark.parametrize('header,expected', [
+    (['sender_code', 'invitees', 'sender_phone'], (0, 1, 2)),
+    # sender_phone מכיל "sender": הטלפון מזוהה ראשון ולא נתפס כקוד שולח
+    (['sender_phone', 'invitees', 'sender_code'], (2, 1, 0)),
+    (['sender mobile', 'invitees'], (None, 1, 0)),
+    (['Sender Mobile', 'Guests list', 'Order Code #'], (2, 1, 0)),
+    (['טלפון שולח', 'מוזמנים', 'קוד שולח'], (2, 1, 0)),
+    (['קוד', 'מוזמנים', 'טלפון'], (0, 1, 2)),
+    (['﻿קוד שולח', ' מוזמנים ', '"טלפון"'], (0, 1, 2)),
+    (['foo', 'bar'], (None, None, None)),
+])
+def test_resolve_order_columns(header, expected):
+    cols = resolve_order_columns(header)
+    assert (cols['sender_code'], cols['invitees'], cols['sender_phone']) == expected
+
+
+def test_phone_column_never_becomes_sender_code():
+    # הבאג שתוקן: עמודת טלפון בלבד (בלי קוד) נקראה כקוד שולח, והמספר נשמר כ-sender_code
+    cols = resolve_order_columns(['sender_phone', 'invitees'])
+    assert cols['sender_code'] is None and cols['sender_phone'] == 0
+
+
+VALUES = ['12', '12.0', ' 12 ', '1,234', 'abc', '', None, '0501234567', '1e3', '.5', '12.9', '-5', '1.2.3', 'קוד 7']
+
+
+def test_clean_int_column_matches_clean_int_str():
+    assert list(clean_int_column(pd.Series(VALUES))) == [clean_int_str(v) for v in VALUES]
+
+
+def test_clean_int_column_keeps_out_of_range_text():
+    # clean_int_str מעגל דרך float (100000000000000000000); כאן הטקסט נשמר, כי אין לו ייצוג bigint מדויק
+    assert list(clean_int_column(pd.Series(['99999999999999999999']))) == ['99999999999999999999']
+
+
+def test_normalize_order_chunk():
+    df = pd.DataFrame([['12.0', '1|2', ' 050-1234567 '], ['', '', ''], ['', '3', ''], ['x5', '', None]])
+    out = normalize_order_chunk(df, {'sender_code': 0, 'invitees': 1, 'sender_phone': 2})
+    assert out.to_dict('records') == [
+        {'sender_code': '12', 'invitees': '1|2', 'sender_phone': '050-1234567'},
+        {'sender_code': None, 'invitees': '3', 'sender_phone': None},
+        {'sender_code': '5', 'invitees': '', 'sender_phone': None},
+    ]
@@ -0,0 +1,88 @@
+import re
+
+import pytest
+
+from app import normalize_phone
+
+
+def format_il_phone(p_text, p_default_area='02'):
+    # העתקה שורה-שורה של format_il_phone (מיגרציה 0012)
+    e = p_text
+    if e is None or e.strip() == '': return None
+    e = re.sub(r'\D', '', e)
+    if e[:3] == '972': e = '0' + e[3:]
+    if re.fullmatch(r'5[0-9]{8}|[23489][0-9]{7}', e): e = '0' + e
+    if e[:1] != '0': e = p_default_area + e
+    e = re.sub(r'^0+', '0', e)
+    if len(e) == 7: e = p_default_area + e
+    return e if 7 <= len(e) <= 10 else None
+
+
+def legacy_normalize_phone(p):
+    # normalize_phone לפני user-004: בלי קידומת ברירת מחדל ובלי בדיקת אורך
+    if not p: return None
+    clean = re.sub(r'\D', '', str(p))
+    if not clean: return None
+    if clean.startswith('972'): clean = '0' + clean[3:]
+    clean = clean.lstrip('0')
+    return '0' + clean
+
+
+SAMPLES = [
+    '050-1234567', '0501234567', '+972-50-1234567', '972501234567', '(050) 1234567', '050 123 4567', ' 050-1234567 ',
+    '050.1234567', '02-5812345', '025812345', '+972-2-5812345', '5812345', '1234567', '00501234567', '00972501234567',
+    '0', '', '   ', None, 'אין', '050-123', '0501234567890', '*2700', '+1 (212) 555-0100',
+    '501234567', '21234567', '31234567', '91234567', '51234567', '601234567',
+]
+
+
+@pytest.mark.parametrize('raw', SAMPLES)
+def test_matches_format_il_phone(raw):
+    assert normalize_phone(raw) == format_il_phone(raw)
+
+
+@pytest.mark.parametrize('raw,expected', [
+    ('050-1234567', '0501234567'),
+    ('+972-50-1234567', '0501234567'),
+    ('972501234567', '0501234567'),
+    ('(02) 581-2345', '025812345'),
+    ('5812345', '025812345'),  # 7 ספרות בלי קידומת = ירושלים, כמו ב-SQL
+    ('00501234567', '0501234567'),
+    # אפס מוביל שנפל במעבר דרך Excel
+    ('501234567', '0501234567'),
+    ('21234567', '021234567'),
+    ('31234567', '031234567'),
+    (501234567, '0501234567'),
+])
+def test_formats(raw, expected):
+    assert normalize_phone(raw) == expected
+
+
+def test_default_area():
+    assert normalize_phone('5812345', default_area='03') == format_il_phone('5812345', '03') == '035812345'
+
+
+@pytest.mark.parametrize('raw', ['050-1234567', '+972-50-1234567', '972501234567', '02-5812345', '(050) 123-4567',
+                                 '501234567', '21234567'])
+def test_agrees_with_legacy_on_well_formed_numbers(raw):
+    assert normalize_phone(raw) == legacy_normalize_phone(raw)
+
+
+@pytest.mark.parametrize('raw,legacy', [
+    # קידומת בינלאומית עם 00: אחרי הסרת האפסים נשארות 13 ספרות, ו-format_il_phone מחזיר NULL.
+    # זו הכוונה: מפתח שה-SQL לא מייצר (הישן החזיר 0972501234567) לא מתאים לאף תושב בכל מקרה
+    ('00972501234567', '0972501234567'),
+    # מספר קצר/חלקי לא הופך למפתח (הישן החזיר 0 + הספרות)
+    ('050-123', '050123'),
+    ('0', '0'),
+    # 7 ספרות מקבלות את קידומת ברירת המחדל
+    ('5812345', '05812345'),
+])
+def test_intended_differences_from_legacy(raw, legacy):
+    assert legacy_normalize_phone(raw) == legacy
+    assert normalize_phone(raw) == format_il_phone(raw)
+    assert normalize_phone(raw) != legacy
+
+
+def test_international_double_zero_prefix_is_rejected():
+    assert normalize_phone('00972501234567') is None
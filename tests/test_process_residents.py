@@ -0,0 +1,126 @@
+import os
+import sys
+
+import pytest
+
+from app import get_db_connection, run_migrations
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+from benchdb import LEGACY_PROCESS_RESIDENTS_SQL, merge_snapshot  # noqa: E402
+
+# (personid, lastname, phone, mobile, email, standing_order, streetcode)
+EXISTING = [
+    (10, 'כהן', '02-5812345', None, 'cohen@example.com', 1, 999),
+    (11, 'לוי', '050-1111111', None, None, 0, 999),
+    (4500, 'ידני', None, '054-2222222', None, None, 999),
+]
+
+# (code, lastname, phone, mobile, email, standing_order, streetcode)
+CASES = {
+    # קוד שחוזר בקובץ: הראשונה מוסיפה עם הקוד, השנייה מעדכנת (NULL לא דורס)
+    'repeated_code': [
+        (500, 'אברהם', '050-3000001', None, 'a@example.com', 1, 999),
+        (500, None, '050-3000002', None, 'b@example.com', None, None),
+        (500, 'אברהם ב', None, None, None, 0, 999),
+    ],
+    # טלפון שחוזר בקובץ בלי קוד: הראשונה מקבלת מספר מהמונה, השאר מעדכנות אותה
+    'repeated_phone': [
+        (None, 'יצחק', '050-3000003', None, None, 1, 999),
+        (None, 'יצחק ב', '0503000003', None, 'c@example.com', None, None),
+        (None, None, '+972-50-3000003', None, None, 0, 999),
+    ],
+    # שורת קוד ושורת טלפון של אותו אדם לסירוגין
+    'interleaved_code_phone': [
+        (600, 'יעקב', '050-3000004', None, None, 1, 999),
+        (None, 'יעקב ב', '050-3000004', None, 'd@example.com', None, None),
+        (601, 'רחל', '050-3000004', None, None, 0, 999),
+        (600, None, '050-3000005', None, 'e@example.com', 1, None),
+        (None, 'יעקב ג', '050-3000005', None, None, None, 999),
+        (601, 'רחל ב', None, None, None, None, None),
+    ],
+    # בלי קוד, בלי טלפון או עם טלפונים שונים: כל שורה מוסיפה אדם חדש מהמונה
+    'null_codes': [
+        (None, 'משה', None, None, None, None, 999),
+        (None, 'משה', None, None, None, None, 999),
+        (None, 'אהרן', '050-3000006', None, None, 1, 999),
+        (None, 'מרים', '050-3000007', None, None, 0, 999),
+        (None, None, 'אין', None, None, None, None),
+    ],
+    # התאמה לתושבים קיימים: לפי קוד, לפי טלפון בלי קוד, ולפי טלפון כשהקוד לא קיים
+    'existing_people': [
+        (10, 'כהן חדש', None, None, None, None, None),
+        (None, None, '025812345', None, 'new@example.com', 0, None),
+        (700, 'לוי ב', '0501111111', None, None, None, 999),
+        (4500, None, '054-2222222', None, 'x@example.com', 1, None),
+        (None, 'חדש', '054-2222222', None, None, None, 999),
+    ],
+    # אפס מוביל שנפל: מתאים לתושב קיים לפי format_il_phone
+    'missing_leading_zero': [
+        (None, 'כהן ג', '25812345', None, None, None, None),
+        (None, 'לוי ג', '501111111', None, None, None, None),
+    ],
+}
+
+
+@pytest.fixture(scope='module')
+def cur():
+    if not os.getenv('DATABASE_URL'):
+        pytest.skip('DATABASE_URL לא מוגדר (נדרש מסד בדיקות)')
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT current_database()")
+    db = cur.fetchone()[0]
+    if 'bench' not in db and 'test' not in db:
+        conn.close()
+        pytest.skip(f'המסד {db} לא נראה כמו מסד בדיקות (bench/test)')
+    run_migrations(conn)
+    cur.execute(LEGACY_PROCESS_RESIDENTS_SQL)
+    yield cur
+    conn.close()
+
+
+def load(cur, existing, rows):
+    cur.execute('TRUNCATE TABLE "payment_ledger", "Order", "person_archive", "temp_residents_csv" RESTART IDENTITY CASCADE')
+    cur.execute("DELETE FROM person")
+    cur.execute("INSERT INTO street (streetcode, streetname) VALUES (999, 'רחוב כללי') ON CONFLICT (streetcode) DO NOTHING")
+    for r in existing:
+        cur.execute("INSERT INTO person (personid, lastname, phone, mobile, email, standing_order, streetcode) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s)", r)
+    for r in rows:
+        cur.execute("INSERT INTO temp_residents_csv (code, lastname, phone, mobile, email, standing_order, streetcode) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s)", r)
+
+
+def assert_same_as_legacy(cur):
+    new = merge_snapshot(cur, 'process_residents_csv')
+    assert new == merge_snapshot(cur, 'pg_temp.process_residents_csv_legacy')
+    return new
+
+
+@pytest.mark.parametrize('case', list(CASES))
+def test_matches_legacy(cur, case):
+    load(cur, EXISTING, CASES[case])
+    assert_same_as_legacy(cur)
+
+
+def test_matches_legacy_on_all_cases_together(cur):
+    load(cur, EXISTING, [r for rows in CASES.values() for r in rows])
+    assert_same_as_legacy(cur)
+
+
+def test_sequence_floor(cur):
+    # מזהים אוטומטיים מתחילים ב-100,000 כשהקודים הקיימים קטנים, ואחרי המקסימום כשהוא גדול יותר
+    load(cur, EXISTING, CASES['null_codes'])
+    people, _ = assert_same_as_legacy(cur)
+    assert [p[0] for p in people if p[0] > 4500] == [100000, 100001, 100002, 100003, 100004]
+
+    load(cur, EXISTING + [(150000, 'גבוה', None, None, None, None, 999)], CASES['null_codes'])
+    people, _ = assert_same_as_legacy(cur)
+    assert [p[0] for p in people if p[0] > 150000] == [150001, 150002, 150003, 150004, 150005]
+
+
+def test_statuses(cur):
+    load(cur, EXISTING, CASES['interleaved_code_phone'])
+    _, statuses = assert_same_as_legacy(cur)
+    # 601 לא קיים ונמצא לפי הטלפון של 600; עדכון לא משנה טלפון, ולכן שורה 5 מוסיפה; 601 עדיין לא קיים בשורה 6
+    assert [s for _, s in statuses] == ['נוסף', 'עודכן', 'עודכן', 'עודכן', 'נוסף', 'נוסף']
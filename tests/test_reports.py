@@ -0,0 +1,39 @@
+import datetime
+
+import pytest
+
+from app import REPORT_PAGING, decode_page_key, encode_page_key, report_order_by
+
+
+@pytest.mark.parametrize('view,values', [
+    ('v_families_balance', ['כהן', 17]),
+    ('v_packages_per_building', ['', True, None, False]),
+    ('v_orders_details', [123]),
+])
+def test_page_key_round_trip(view, values):
+    token = encode_page_key(values)
+    assert token.isascii() and '/' not in token and '+' not in token  # נכנס ל-URL כמו שהוא
+    assert decode_page_key(token, view) == values
+
+
+def test_page_key_dates_are_strings():
+    assert decode_page_key(encode_page_key([datetime.date(2026, 3, 1), 5]), 'v_families_balance') == ['2026-03-01', 5]
+
+
+@pytest.mark.parametrize('token', ['', 'not base64!', encode_page_key({'a': 1}), encode_page_key(['only one']),
+                                   encode_page_key(['a', 1, 2]), 'bnVsbA=='])
+def test_invalid_page_key_means_first_page(token):
+    assert decode_page_key(token, 'v_families_balance') is None
+
+
+def test_report_order_by():
+    assert report_order_by('v_families_balance') == "COALESCE(lastname, '') ASC, personid ASC"
+    assert report_order_by('v_families_balance', reverse=True) == "COALESCE(lastname, '') DESC, personid DESC"
+    assert report_order_by('v_orders_details') == 'id DESC'
+    assert report_order_by('v_orders_details', reverse=True) == 'id ASC'
+
+
+def test_packages_per_building_key_separates_null_from_empty():
+    # NULL ו-'' הם קבוצות שונות ב-view; בלי עמודת IS NULL לשתיהן אותו מפתח ודפדוף מדלג/חוזר על שורה
+    key = REPORT_PAGING['v_packages_per_building']['key']
+    assert 'streetname IS NULL' in key and 'buildingnumber IS NULL' in key
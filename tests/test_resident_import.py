@@ -0,0 +1,73 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from app import (RAW_RESIDENT_COLUMNS, extract_clean_data, find_header_row, normalize_resident_chunk,
+                 read_table_chunks, read_uploaded_table, resolve_resident_columns)
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import datagen  # noqa: E402
+
+
+def legacy_rows(path):
+    # הנתיב של load_residents_legacy עד ה-INSERT (קובץ פתוח בבינארי, כמו ב-import_residents_job)
+    with open(path, 'rb') as f:
+        df = read_uploaded_table(FileStorage(f, filename=os.path.basename(path)))
+    header_idx = find_header_row(df)
+    df.columns = df.iloc[header_idx]
+    df = df[header_idx + 1:].reset_index(drop=True)
+    rows, _ = extract_clean_data(df)
+    return [tuple(r[c] for c in RAW_RESIDENT_COLUMNS) for r in rows]
+
+
+def stream_rows(path, chunk_rows):
+    # הנתיב של load_residents_stream עד ה-COPY
+    with open(path, 'rb') as f:
+        return list(normalized_chunks(read_table_chunks(FileStorage(f, filename=os.path.basename(path)), chunk_rows)))
+
+
+def normalized_chunks(chunks):
+    first = next(chunks)
+    header_idx = find_header_row(first)
+    header = first.loc[header_idx].tolist()
+    plan, code_col, _ = resolve_resident_columns(header, first.loc[header_idx + 1:])
+    for chunk in [first.loc[header_idx + 1:], *chunks]:
+        clean = normalize_resident_chunk(chunk.reindex(columns=range(len(header))), plan, code_col)
+        yield from (tuple(r) for r in clean.itertuples(index=False))
+
+
+@pytest.mark.parametrize('chunk_rows', [50, 1000])
+def test_stream_matches_legacy_on_generated_file(tmp_path, chunk_rows):
+    path = tmp_path / 'residents.csv'
+    datagen.write_residents(path, 400, seed=3)
+    assert stream_rows(path, chunk_rows) == legacy_rows(path)
+
+
+def test_stream_matches_legacy_on_edge_cases(tmp_path):
+    path = tmp_path / 'x.csv'
+    path.write_text('\n'.join([
+        'דוח תושבים,,,,,',
+        'קוד,שם משפחה,שם פרטי,רחוב,טלפון,הוראת קבע',
+        '12.0,כהן,משה,הרצל,02-5812345,1',
+        ',לוי,,יפו,,',
+        '7,,,,,',
+        ',,,,,',
+        'abc,ביטון,דוד,עזרא,050-1234567,כן',
+        ' 15 , מזרחי ,יעקב, בר אילן ,,0',
+    ]), encoding='utf-8')
+    rows = stream_rows(path, 3)
+    assert rows == legacy_rows(path)
+    # שורה בלי קוד ובלי שם משפחה נזרקת; קוד לא מספרי = 0; הוראת קבע לא מספרית = 0
+    assert [(r[0], r[1]) for r in rows] == [(12, 'כהן'), (0, 'לוי'), (7, ''), (0, 'ביטון'), (15, ' מזרחי ')]
+    assert rows[3][-1] == 0
+
+
+def test_code_column_fallback_to_numeric_first_column():
+    header = ['מס', 'שם משפחה']
+    first = pd.DataFrame([['1', 'כהן'], ['2', 'לוי']])
+    plan, code_col, msg = resolve_resident_columns(header, first)
+    assert code_col == 0 and plan['lastname'] == [1]
+    assert 'מס' in msg